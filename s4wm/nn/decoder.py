@@ -7,6 +7,7 @@ from jax import random
 from flax import linen as nn
 from jax.nn.initializers import glorot_uniform, zeros
 from functools import partial
+from typing import Any
 
 
 class SimpleDecoder(nn.Module):
@@ -79,6 +80,8 @@ class ResNetBlockDecoder(nn.Module):
     act_fn: callable
     c_out: int
     subsample: bool = False
+    dtype: Any = jnp.float32
+    param_dtype: Any = jnp.float32
 
     @nn.compact
     def __call__(self, x):
@@ -88,6 +91,8 @@ class ResNetBlockDecoder(nn.Module):
             strides=(1, 1) if not self.subsample else (2, 2),
             kernel_init=resnet_kernel_init,
             use_bias=False,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
         )(x)
         z = self.act_fn(z)
         z = nn.Conv(
@@ -95,6 +100,8 @@ class ResNetBlockDecoder(nn.Module):
             kernel_size=(2, 2),
             kernel_init=resnet_kernel_init,
             use_bias=False,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
         )(z)
         if self.subsample:
             x = nn.ConvTranspose(
@@ -102,6 +109,8 @@ class ResNetBlockDecoder(nn.Module):
                 kernel_size=(1, 1),
                 strides=(2, 2),
                 kernel_init=resnet_kernel_init,
+                dtype=self.dtype,
+                param_dtype=self.param_dtype,
             )(x)
 
         x_out = self.act_fn(z + x)
@@ -113,11 +122,17 @@ class ResNetDecoder(nn.Module):
     block_class: nn.Module = ResNetBlockDecoder
     num_blocks: tuple = (1, 1, 1)
     c_hidden: tuple = (64, 32, 16)
+    dtype: Any = jnp.float32
+    param_dtype: Any = jnp.float32
 
     @nn.compact
     def __call__(self, x):
         # A first convolution on the original image to scale up the channel size
-        x = nn.Dense(features=5 * 8 * self.c_hidden[0])(x)
+        x = nn.Dense(
+            features=5 * 8 * self.c_hidden[0],
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
+        )(x)
         x = self.act_fn(x)
         x = x.reshape(x.shape[0], x.shape[1], 5, 8, self.c_hidden[0])
 
@@ -128,6 +143,8 @@ class ResNetDecoder(nn.Module):
             padding=(1, 1),
             kernel_init=resnet_kernel_init,
             use_bias=False,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
         )(x)
         x = self.act_fn(x)
         x = nn.ConvTranspose(
@@ -137,6 +154,8 @@ class ResNetDecoder(nn.Module):
             padding=(1, 2),
             kernel_init=resnet_kernel_init,
             use_bias=False,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
         )(x)
 
         x = self.act_fn(x)
@@ -149,6 +168,8 @@ class ResNetDecoder(nn.Module):
                     c_out=self.c_hidden[block_idx],
                     act_fn=self.act_fn,
                     subsample=subsample,
+                    dtype=self.dtype,
+                    param_dtype=self.param_dtype,
                 )(x)
 
         x = nn.ConvTranspose(
@@ -157,6 +178,8 @@ class ResNetDecoder(nn.Module):
             strides=(2, 2),
             kernel_init=resnet_kernel_init,
             use_bias=False,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
         )(x)
 
         return nn.sigmoid(jnp.squeeze(x[:, :, :-1, :-8], axis=-1))
@@ -1,10 +1,9 @@
+import math
 import jax
 import jax.numpy as jnp
 
-from tensorflow_probability.substrates import jax as tfp
-
-tfd = tfp.distributions
-tfm = tfp.math
+from functools import partial
+from typing import Sequence, Tuple, Union
 
 tree_map = jax.tree_util.tree_map
 sg = lambda x: tree_map(
@@ -12,32 +11,153 @@ sg = lambda x: tree_map(
 )  # stop gradient - used for KL balancing
 
 
-class OneHotDist(tfd.OneHotCategorical):
+@partial(jax.custom_vjp, nondiff_argnums=(1,))
+def _scale_grad(x: jnp.ndarray, scale: float) -> jnp.ndarray:
+    return x
+
+
+_scale_grad.defvjp(lambda x, scale: (x, None), lambda scale, _, g: (scale * g,))
+scale_grad = lambda x, scale: tree_map(
+    lambda x: _scale_grad(x, scale), x
+)  # identity with the gradient scaled - used for single pass KL balancing
+
+
+def _categorical_kl_fwd(
+    logits_p: jnp.ndarray, logits_q: jnp.ndarray
+) -> Tuple[jnp.ndarray, Tuple[jnp.ndarray, ...]]:
+    log_p = jax.nn.log_softmax(logits_p, axis=-1)
+    log_q = jax.nn.log_softmax(logits_q, axis=-1)
+    p, log_ratio = jnp.exp(log_p), log_p - log_q
+    kl_modes = jnp.sum(p * log_ratio, axis=-1, keepdims=True)
+    return jnp.sum(kl_modes, axis=(-2, -1)), (p, jnp.exp(log_q), log_ratio, kl_modes)
+
+
+def _categorical_kl_bwd(
+    res: Tuple[jnp.ndarray, ...], g: jnp.ndarray
+) -> Tuple[jnp.ndarray, jnp.ndarray]:
+    # Closed form gradients w.r.t. the logits, saves the backward of both softmaxes
+    p, q, log_ratio, kl_modes = res
+    g = g[..., None, None]
+    return g * p * (log_ratio - kl_modes), g * (q - p)
+
+
+@jax.custom_vjp
+def _categorical_kl(logits_p: jnp.ndarray, logits_q: jnp.ndarray) -> jnp.ndarray:
+    """KL between independent categoricals over (..., modes, num_classes) logits"""
+    return _categorical_kl_fwd(logits_p, logits_q)[0]
+
 
-    def __init__(
-        self,
-        logits=None,
-        probs=None,
-        dtype=jnp.float32,
-        validate_args=False,
-        allow_nan_stats=True,
-        name="OneHotCategorical",
-    ):
-        super().__init__(logits, probs, dtype, validate_args, allow_nan_stats, name)
+_categorical_kl.defvjp(_categorical_kl_fwd, _categorical_kl_bwd)
+
+
+@jax.tree_util.register_pytree_node_class
+class OneHotDist:
+    """Independent one hot categoricals over the last axis of the logits (..., modes, num_classes),
+    samples are straight through. The event is (modes, num_classes), like
+    tfd.Independent(tfd.OneHotCategorical(logits), 1)
+    """
+
+    def __init__(self, logits: jnp.ndarray):
+        self.logits = logits
+        self.batch_shape = logits.shape[:-2]
+        self.event_shape = logits.shape[-2:]
+
+    def tree_flatten(self):
+        return (self.logits,), None
 
     @classmethod
-    def _parameter_properties(cls, dtype, num_classes=None):
-        return super()._parameter_properties(dtype)
+    def tree_unflatten(cls, aux_data, children):
+        return cls(*children)
+
+    def __getitem__(self, idx) -> "OneHotDist":
+        return OneHotDist(self.logits[idx])
+
+    def log_probs(self) -> jnp.ndarray:
+        return jax.nn.log_softmax(self.logits, axis=-1)
+
+    def probs(self) -> jnp.ndarray:
+        return jax.nn.softmax(self.logits, axis=-1)
+
+    def sample(self, sample_shape: Sequence[int] = (), seed=None) -> jnp.ndarray:
+        indices = jax.random.categorical(
+            seed, self.logits, shape=tuple(sample_shape) + self.logits.shape[:-1]
+        )
+        sample = jax.nn.one_hot(indices, self.logits.shape[-1], dtype=self.logits.dtype)
+        probs = self.probs()
+        return sg(sample) + (probs - sg(probs))
+
+    def mode(self) -> jnp.ndarray:
+        return jax.nn.one_hot(
+            jnp.argmax(self.logits, axis=-1),
+            self.logits.shape[-1],
+            dtype=self.logits.dtype,
+        )
+
+    def log_prob(self, value: jnp.ndarray) -> jnp.ndarray:
+        return jnp.sum(value * self.log_probs(), axis=(-2, -1))
 
-    def sample(self, sample_shape=(), seed=None):
-        sample = sg(super().sample(sample_shape, seed))
-        probs = self._pad(super().probs_parameter(), sample.shape)
-        return sg(sample) + (probs - sg(probs)).astype(sample.dtype)
+    def entropy(self) -> jnp.ndarray:
+        return -jnp.sum(self.probs() * self.log_probs(), axis=(-2, -1))
 
-    def _pad(self, tensor, shape):
-        while len(tensor.shape) < len(shape):
-            tensor = tensor[None]
-        return tensor
+    def kl_divergence(self, other: "OneHotDist") -> jnp.ndarray:
+        return _categorical_kl(self.logits, other.logits)
+
+
+@jax.tree_util.register_pytree_node_class
+class DiagGaussianDist:
+    """Gaussian with a diagonal covariance over the last axis, like tfd.MultivariateNormalDiag"""
+
+    def __init__(self, mean: jnp.ndarray, std: jnp.ndarray):
+        self._mean = mean
+        self.std = std
+        self.batch_shape = mean.shape[:-1]
+        self.event_shape = mean.shape[-1:]
+
+    def tree_flatten(self):
+        return (self._mean, self.std), None
+
+    @classmethod
+    def tree_unflatten(cls, aux_data, children):
+        return cls(*children)
+
+    def __getitem__(self, idx) -> "DiagGaussianDist":
+        return DiagGaussianDist(self._mean[idx], self.std[idx])
+
+    def mean(self) -> jnp.ndarray:
+        return self._mean
+
+    def mode(self) -> jnp.ndarray:
+        return self._mean
+
+    def sample(self, sample_shape: Sequence[int] = (), seed=None) -> jnp.ndarray:
+        shape = tuple(sample_shape) + self._mean.shape
+        eps = jax.random.normal(seed, shape, dtype=self._mean.dtype)
+        return self._mean + self.std * eps
+
+    def log_prob(self, value: jnp.ndarray) -> jnp.ndarray:
+        z = (value - self._mean) / self.std
+        return -jnp.sum(
+            0.5 * z**2 + jnp.log(self.std) + 0.5 * math.log(2 * math.pi), axis=-1
+        )
+
+    def entropy(self) -> jnp.ndarray:
+        return jnp.sum(
+            jnp.log(self.std) + 0.5 * math.log(2 * math.pi * math.e), axis=-1
+        )
+
+    def kl_divergence(self, other: "DiagGaussianDist") -> jnp.ndarray:
+        var_ratio = (self.std / other.std) ** 2
+        t = ((self._mean - other._mean) / other.std) ** 2
+        return 0.5 * jnp.sum(var_ratio + t - 1 - jnp.log(var_ratio), axis=-1)
+
+
+LatentDist = Union[OneHotDist, DiagGaussianDist]
+
+
+def log_cosh(x: jnp.ndarray) -> jnp.ndarray:
+    # Stable for large |x|, log(cosh(x)) = |x| + log(1 + exp(-2|x|)) - log(2)
+    x = jnp.abs(x)
+    return x + jax.nn.softplus(-2 * x) - math.log(2)
 
 
 class MSEDist:
@@ -80,14 +200,14 @@ class LogCoshDist:
         assert self._mode.shape == value.shape, (self._mode.shape, value.shape)
         if self._agg == "mean":
             loss = jnp.mean(
-                tfm.log_cosh(value - self._mode),
+                log_cosh(value - self._mode),
                 axis=-1,
             )
 
         elif self._agg == "sum":
             return (
                 jnp.sum(
-                    tfm.log_cosh(value - self._mode),
+                    log_cosh(value - self._mode),
                     axis=-1,
                 ),
             )
@@ -95,3 +215,6 @@ class LogCoshDist:
         else:
             raise NotImplementedError(self._agg)
         return -loss
+
+
+ImageDist = Union[MSEDist, LogCoshDist]
@@ -6,6 +6,7 @@ from jax import random
 from flax import linen as nn
 from jax.nn.initializers import glorot_uniform, zeros
 from functools import partial
+from typing import Any
 
 
 class SimpleEncoder(nn.Module):
@@ -69,6 +70,8 @@ class ResNetBlock(nn.Module):
     act_fn: callable
     c_out: int
     subsample: bool = False
+    dtype: Any = jnp.float32
+    param_dtype: Any = jnp.float32
 
     @nn.compact
     def __call__(self, x):
@@ -78,6 +81,8 @@ class ResNetBlock(nn.Module):
             strides=(1, 1) if not self.subsample else (2, 2),
             kernel_init=resnet_kernel_init,
             use_bias=False,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
         )(x)
         z = self.act_fn(z)
         z = nn.Conv(
@@ -85,6 +90,8 @@ class ResNetBlock(nn.Module):
             kernel_size=(2, 2),
             kernel_init=resnet_kernel_init,
             use_bias=False,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
         )(z)
         if self.subsample:
             x = nn.Conv(
@@ -92,6 +99,8 @@ class ResNetBlock(nn.Module):
                 kernel_size=(1, 1),
                 strides=(2, 2),
                 kernel_init=resnet_kernel_init,
+                dtype=self.dtype,
+                param_dtype=self.param_dtype,
             )(x)
 
         x_out = self.act_fn(z + x)
@@ -103,6 +112,8 @@ class ResNetEncoder(nn.Module):
     block_class: nn.Module = ResNetBlock
     num_blocks: tuple = (1, 1, 1)
     c_hidden: tuple = (16, 32, 64)
+    dtype: Any = jnp.float32
+    param_dtype: Any = jnp.float32
 
     @nn.compact
     def __call__(self, x):
@@ -112,6 +123,8 @@ class ResNetEncoder(nn.Module):
             strides=(2, 2),
             kernel_init=resnet_kernel_init,
             use_bias=False,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
         )(x)
         x = self.act_fn(x)
         x = nn.Conv(
@@ -120,6 +133,8 @@ class ResNetEncoder(nn.Module):
             strides=(2, 2),
             kernel_init=resnet_kernel_init,
             use_bias=False,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
         )(x)
         x = self.act_fn(x)
 
@@ -131,6 +146,8 @@ class ResNetEncoder(nn.Module):
                     c_out=self.c_hidden[block_idx],
                     act_fn=self.act_fn,
                     subsample=subsample,
+                    dtype=self.dtype,
+                    param_dtype=self.param_dtype,
                 )(x)
 
         return x.reshape(x.shape[0], x.shape[1], -1)
@@ -3,16 +3,209 @@ import jax
 
 from flax import linen as nn
 from jax.nn.initializers import normal
+from functools import partial
+from jax.experimental.shard_map import shard_map
+from jax.sharding import PartitionSpec
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Literal,
+    Tuple,
+    Union,
+)
 
 from .s4_ssm import (
     hippo_initializer,
     log_step_initializer,
     kernel_DPLR,
     discrete_DPLR,
-    causal_convolution,
+    discrete_DPLR_factors,
+    discrete_DPLR_step,
+    initial_state_DPLR,
+    final_state_DPLR,
+    propagate_DPLR,
+    ConvMode,
+    apply_kernel,
     scan_SSM,
+    scan_SSM_DPLR,
+    kernel_S4D,
+    discrete_S4D,
+    scan_SSM_diag,
+    prefill_S4D,
+    discrete_S5,
+    scan_SSM_assoc,
 )
 
+RematPolicy = Literal[
+    "none", "sequence_block", "s4_block", "encoder_decoder", "matmuls"
+]
+
+# Name of the vmapped batch axis of S4Blocks
+BATCH_AXIS = "batch"
+# Default name of the mesh axis the time axis is sharded over, see sequence_parallel
+SEQ_AXIS = "seq"
+
+
+def remat(module: type, policy: RematPolicy, granularity: RematPolicy) -> type:
+    """Rematerialise the activations of module in the backward pass when the policy applies
+    to it: "sequence_block" and "s4_block" recompute everything within that granularity,
+    "matmuls" saves the outputs of matmuls of every SequenceBlock and recomputes the rest
+    """
+    if policy == "matmuls" and granularity == "sequence_block":
+        return nn.remat(module, policy=jax.checkpoint_policies.checkpoint_dots)
+    if policy == granularity:
+        return nn.remat(module)
+    return module
+
+
+class Precision(NamedTuple):
+    """dtypes of a submodule: parameters are stored in param_dtype, computations run in dtype
+    and the outputs are cast to output_dtype
+    """
+
+    param_dtype: Any = jnp.float32
+    dtype: Any = jnp.float32
+    output_dtype: Any = jnp.float32
+
+
+def get_precision(precision: Optional[Dict], submodule: str) -> Precision:
+    """Precision of a submodule ("encoder", "decoder", "heads" or "s4_blocks") from a config
+    mapping submodule names to {param_dtype, dtype, output_dtype} dtype names. Missing entries
+    fall back to the "default" entry and then to float32. The SSM layers are not covered, they
+    always run in float32 / complex64.
+    """
+    precision = precision or {}
+    dtypes = {**precision.get("default", {}), **precision.get(submodule, {})}
+    return Precision(**{k: jnp.dtype(v) for k, v in dtypes.items()})
+
+
+def cast_params(params: Dict, param_dtype: Any) -> Dict:
+    """Cast floating point parameters to param_dtype, except for those of the SSM layers"""
+    return {
+        k: (
+            v
+            if k == "seq"
+            else (
+                cast_params(v, param_dtype)
+                if hasattr(v, "keys")
+                else (
+                    v.astype(param_dtype)
+                    if jnp.issubdtype(v.dtype, jnp.floating)
+                    else v
+                )
+            )
+        )
+        for k, v in params.items()
+    }
+
+
+def frozen_kernel(layer: nn.Module, init_kernel: Callable) -> jnp.ndarray:
+    """Convolution kernel of a CNN mode layer. With a mutable "prime" collection the kernel
+    is computed and stored, afterwards it is read from "prime" instead of being recomputed,
+    as long as the parameters stay frozen (see S4WM.init_CNN_mode)
+    """
+    if layer.is_mutable_collection("prime"):
+        K = init_kernel()
+        layer.put_variable("prime", "kernel", K)
+        return K
+    if layer.has_variable("prime", "kernel"):
+        return layer.get_variable("prime", "kernel")
+    return init_kernel()
+
+
+def cnn_state(
+    layer: nn.Module,
+    shape: Tuple[int, ...],
+    name: str = "cache_x_k",
+    dtype: Any = jnp.complex64,
+) -> Optional[nn.Variable]:
+    """State of a CNN mode layer in the format of the RNN mode "cache". When a "cache"
+    collection is passed the convolution starts from its state, and when it is mutable the
+    state after the last step is stored, so that a whole context can be ingested in one
+    parallel call and then stepped from in RNN mode (see S4WM.prefill_RNN_mode)
+    """
+    if layer.is_initializing() or not (
+        layer.is_mutable_collection("cache") or layer.has_variable("cache", name)
+    ):
+        return None
+    return layer.variable("cache", name, lambda: jnp.zeros(shape, dtype=dtype))
+
+
+def pass_chunk_states(
+    x_chunk: jnp.ndarray,
+    propagate: Callable,
+    x_0: Optional[jnp.ndarray],
+    axis_name: str,
+) -> Tuple[jnp.ndarray, jnp.ndarray]:
+    """State passing between the chunks of a sequence split over the devices of axis_name.
+    x_chunk is the final state of the local chunk started from zero and propagate steps a
+    state over one chunk without input, so the chunk c starts from
+    x_c = propagate(x_c-1) + x_chunk_c-1. Returns the initial state of the local chunk and the
+    final state of the whole sequence, starting from x_0 or zero.
+    """
+    x_chunks = jax.lax.all_gather(x_chunk, axis_name)
+    if x_0 is None:
+        x_0 = jnp.zeros_like(x_chunk)
+
+    def step(x, x_chunk):
+        return propagate(x) + x_chunk, x
+
+    x_L, x_init = jax.lax.scan(step, x_0, x_chunks)
+    return x_init[jax.lax.axis_index(axis_name)], x_L
+
+
+def sequence_parallel(
+    fn: Callable, mesh: jax.sharding.Mesh, axis_name: str = SEQ_AXIS
+) -> Callable:
+    """Shard fn(variables, x) -> y of an S4Blocks built with seq_axis_name=axis_name over the
+    time axis of x and y (batch, l, d_model), with the variables replicated. Every device
+    convolves its own chunk of l / n_devices steps and the chunks exchange their SSM states
+    (see pass_chunk_states), so the activations of a long sequence are split over the mesh.
+    """
+    return shard_map(
+        fn,
+        mesh=mesh,
+        in_specs=(PartitionSpec(), PartitionSpec(None, axis_name)),
+        out_specs=PartitionSpec(None, axis_name),
+        check_rep=False,
+    )
+
+
+def stack_blocks(
+    n_blocks: int, scan_blocks: bool, policy: RematPolicy, **block_args
+) -> Union[nn.Module, List[nn.Module]]:
+    """S4Blocks of a stack, either unrolled or one nn.scan over the blocks (see S4Blocks)"""
+    if scan_blocks and n_blocks > 0:
+        return nn.scan(
+            remat(ScannedS4Block, policy, "s4_block"),
+            variable_axes={"params": 0, "cache": 0, "prime": 0},
+            split_rngs={"params": True, "dropout": True, "drop_path": True},
+            length=n_blocks,
+        )(**block_args)
+    block_cls = remat(S4Block, policy, "s4_block")
+    return [block_cls(**block_args) for _ in range(n_blocks)]
+
+
+def apply_blocks(
+    blocks: Union[nn.Module, List[nn.Module]],
+    x: jnp.ndarray,
+    drop_rates: Optional[jnp.ndarray] = None,
+) -> jnp.ndarray:
+    """Apply a stack of stack_blocks, drop_rates (n_blocks, n_layers) are the stochastic depth
+    rates of its SequenceBlocks, None disables stochastic depth
+    """
+    if isinstance(blocks, nn.Module):
+        x, _ = blocks(x, drop_rates)
+        return x
+
+    for i, block in enumerate(blocks):
+        x = block(x, None if drop_rates is None else drop_rates[i])
+    return x
+
 
 class S4Blocks(nn.Module):
     layer: dict  # Extra arguments to pass into layer constructor
@@ -23,28 +216,228 @@ class S4Blocks(nn.Module):
     training: bool = True
     embedding: bool = False
     rnn_mode: bool = False
+    # Stack the blocks with nn.scan, so that the compiled program does not grow with depth.
+    # The variables of the blocks are stacked on a leading axis, see S4Blocks_to_scanned.
+    scan_blocks: bool = False
+    # Activations recomputed in the backward pass during training, see remat
+    remat: RematPolicy = "none"
+    # Computation and parameter dtypes of the Dense and LayerNorm layers, the SSMs use float32
+    dtype: Any = jnp.float32
+    param_dtype: Any = jnp.float32
+    # The last pooled_blocks of the n_blocks run on the sequence down pooled by pool_factor,
+    # see PooledS4Blocks
+    pooled_blocks: int = 0
+    pool_factor: int = 1
+    # Stochastic depth rate of the last SequenceBlock during training, growing linearly from
+    # 0 for the first one. Dropped residual branches are skipped, see SequenceBlock.
+    drop_path: float = 0.0
+    # Mesh axis the time axis is sharded over in CNN mode, passed on to the SSM layers. The
+    # stack has to be applied within sequence_parallel.
+    seq_axis_name: Optional[str] = None
 
     def setup(self) -> None:
-        self.dense = nn.Dense(features=self.d_model)
-        self.blocks = [
-            S4Block(
-                layer=self.layer,
-                d_model=self.d_model,
-                n_layers=self.n_layers,
-                dropout=self.dropout,
-                training=self.training,
-                embedding=self.embedding,
-                rnn_mode=self.rnn_mode,
+        self.dense = nn.Dense(
+            features=self.d_model, dtype=self.dtype, param_dtype=self.param_dtype
+        )
+        layer = dict(self.layer)
+        if self.seq_axis_name is not None and not self.rnn_mode:
+            assert (
+                self.pooled_blocks == 0
+            ), "Pooled blocks can not be applied to a sharded sequence"
+            layer["seq_axis_name"] = self.seq_axis_name
+        block_args = dict(
+            layer=layer,
+            d_model=self.d_model,
+            n_layers=self.n_layers,
+            dropout=self.dropout,
+            training=self.training,
+            embedding=self.embedding,
+            rnn_mode=self.rnn_mode,
+            remat=self.remat,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
+        )
+        policy = self.remat if self.training else "none"
+
+        self.blocks = stack_blocks(
+            self.n_blocks - self.pooled_blocks, self.scan_blocks, policy, **block_args
+        )
+        if self.pooled_blocks > 0:
+            self.pooled = PooledS4Blocks(
+                block_args=block_args,
+                n_blocks=self.pooled_blocks,
+                pool_factor=self.pool_factor,
+                scan_blocks=self.scan_blocks,
+                policy=policy,
             )
-            for _ in range(self.n_blocks)
-        ]
 
     def __call__(self, x: jnp.ndarray) -> None:
-        for block in self.blocks:
-            x = block(x)
+        drop_rates = None
+        if self.training and not self.rnn_mode and self.drop_path > 0:
+            drop_rates = jnp.linspace(
+                0.0, self.drop_path, self.n_blocks * self.n_layers
+            ).reshape(self.n_blocks, self.n_layers)
+
+        n_blocks = self.n_blocks - self.pooled_blocks
+        x = apply_blocks(
+            self.blocks, x, None if drop_rates is None else drop_rates[:n_blocks]
+        )
+        if self.pooled_blocks > 0:
+            x = x + self.pooled(
+                x, None if drop_rates is None else drop_rates[n_blocks:]
+            )
         return x
 
 
+class PooledS4Blocks(nn.Module):
+    """S4Blocks on a sequence down pooled by pool_factor, as in SaShiMi (Goel et al., 2022).
+    Groups of pool_factor steps are projected to one step and the output of the coarse
+    blocks is projected back to pool_factor steps. The outputs are shifted by one group, so
+    that each step only sees the groups that were complete before it.
+
+    In RNN mode the inputs are collected in a buffer and the coarse blocks are stepped once
+    every pool_factor steps, the position within the group is kept as "phase" in the cache.
+    The phase is shared by the batch, so that the coarse blocks run on one step of every
+    group for the whole batch. A sequence reset with reset_RNN_cache keeps the phase and
+    continues the group with zeroed buffers, as if it was preceded by zero inputs. A CNN mode
+    prefill (see S4WM.prefill_RNN_mode) has to start at a group boundary.
+    """
+
+    block_args: dict
+    n_blocks: int
+    pool_factor: int
+    scan_blocks: bool = False
+    policy: RematPolicy = "none"
+
+    def setup(self) -> None:
+        k, d_model = self.pool_factor, self.block_args["d_model"]
+        dtypes = dict(
+            dtype=self.block_args["dtype"], param_dtype=self.block_args["param_dtype"]
+        )
+        self.down = nn.Dense(d_model, **dtypes)
+        self.up = nn.Dense(k * d_model, **dtypes)
+
+        # The coarse SSMs see sequences of at most l_max / k steps
+        layer = dict(self.block_args["layer"])
+        layer["l_max"] = -(-layer["l_max"] // k)
+        self.blocks = stack_blocks(
+            self.n_blocks,
+            self.scan_blocks,
+            self.policy,
+            **{**self.block_args, "layer": layer},
+        )
+
+        buffer = lambda: jnp.zeros((k, d_model), dtype=jnp.float32)
+        if self.block_args["rnn_mode"]:
+            self.inputs = self.variable("cache", "pool_inputs", buffer)
+            self.outputs = self.variable("cache", "pool_outputs", buffer)
+            self.phase = self.variable("cache", "phase", jnp.zeros, (), jnp.int32)
+        else:
+            self.outputs = cnn_state(self, (k, d_model), "pool_outputs", jnp.float32)
+            if self.outputs is not None:
+                self.inputs = cnn_state(self, (k, d_model), "pool_inputs", jnp.float32)
+                self.phase = cnn_state(self, (), "phase", jnp.int32)
+
+    def pool(
+        self, x: jnp.ndarray, drop_rates: Optional[jnp.ndarray] = None
+    ) -> jnp.ndarray:
+        """Coarse blocks on complete groups, (n_groups * k, H) -> (n_groups, k, H)"""
+        k, (L, H) = self.pool_factor, x.shape
+        z = self.down(x.reshape(L // k, k * H))
+        z = self.up(apply_blocks(self.blocks, z, drop_rates))
+        return z.reshape(L // k, k, H)
+
+    def __call__(
+        self, x: jnp.ndarray, drop_rates: Optional[jnp.ndarray] = None
+    ) -> jnp.ndarray:
+        if self.block_args["rnn_mode"]:
+            return jnp.concatenate([self.step(x_k) for x_k in x])
+
+        k, (L, H) = self.pool_factor, x.shape
+        # Only complete groups are pooled, the output of the last partial group would only
+        # be seen by steps beyond L. The first group sees the zero output of the shift, or
+        # the pooled output of the preceding context that a prefill starts from.
+        n_groups = L // k
+        if n_groups == 0 and self.is_initializing():
+            x = jnp.pad(x, [(0, k - L), (0, 0)])
+            n_groups = 1
+
+        y = (
+            self.outputs.value
+            if self.outputs is not None
+            else jnp.zeros((k, H), dtype=jnp.float32)
+        )
+        if n_groups > 0:
+            z = self.pool(x[: n_groups * k], drop_rates).astype(y.dtype)
+            y = jnp.concatenate((y[jnp.newaxis], z))
+        else:
+            y = y[jnp.newaxis]
+
+        if self.outputs is not None and self.is_mutable_collection("cache"):
+            # State after the last step for stepping on in RNN mode. The prefill has to start
+            # at a group boundary, with phase 0, and the partial group is kept in the buffer.
+            rest = x[n_groups * k :]
+            self.inputs.value = jnp.pad(rest, [(0, k - rest.shape[0]), (0, 0)])
+            self.outputs.value = y[-1]
+            self.phase.value = jnp.asarray(rest.shape[0], dtype=jnp.int32)
+
+        return y.reshape(-1, H)[:L].astype(x.dtype)
+
+    def step(self, x_k: jnp.ndarray) -> jnp.ndarray:
+        # Every sequence holds a copy of the phase of the batch, so that the cache keeps the
+        # batch layout of the other states. Taken over the batch it is not batched, and
+        # nn.cond below skips the coarse blocks instead of computing and masking them.
+        k, phase = self.pool_factor, jax.lax.pmax(self.phase.value, BATCH_AXIS)
+        y_k = self.outputs.value[phase]
+        inputs = self.inputs.value.at[phase].set(x_k)
+        pooled = phase == k - 1
+
+        if self.is_mutable_collection("prime"):
+            # Creates the variables and the discretised SSMs of the coarse blocks outside of
+            # nn.cond, whose branches have to see the same variables
+            outputs = self.pool_step(inputs, pooled)
+        else:
+            outputs = nn.cond(
+                pooled,
+                lambda mdl, inputs, pooled: mdl.pool_step(inputs, pooled),
+                lambda mdl, inputs, pooled: mdl.outputs.value,
+                self,
+                inputs,
+                pooled,
+            )
+
+        if self.is_mutable_collection("cache") and not self.is_mutable_collection(
+            "prime"
+        ):
+            self.inputs.value = inputs
+            self.outputs.value = outputs
+            self.phase.value = (phase + 1) % k
+        return y_k[jnp.newaxis].astype(x_k.dtype)
+
+    def pool_step(self, inputs: jnp.ndarray, pooled: jnp.ndarray) -> jnp.ndarray:
+        """Step the coarse blocks on a group of inputs, keeping their previous state and
+        outputs unless pooled
+        """
+        # The variables are updated in place, the tree is copied to keep the previous state
+        cache = jax.tree_util.tree_map(lambda x: x, self.variables.get("cache", {}))
+        outputs = self.pool(inputs)[0].astype(jnp.float32)
+
+        if self.is_mutable_collection("cache"):
+            stepped = self.variables["cache"]
+            for name in cache:
+                if name not in ("pool_inputs", "pool_outputs", "phase"):
+                    self.put_variable(
+                        "cache",
+                        name,
+                        jax.tree_util.tree_map(
+                            lambda new, old: jnp.where(pooled, new, old),
+                            stepped[name],
+                            cache[name],
+                        ),
+                    )
+        return jnp.where(pooled, outputs, self.outputs.value)
+
+
 class S4Block(nn.Module):
     layer: dict
     d_model: int
@@ -53,29 +446,45 @@ class S4Block(nn.Module):
     training: bool = True
     embedding: bool = False
     rnn_mode: bool = False
+    remat: RematPolicy = "none"
+    dtype: Any = jnp.float32
+    param_dtype: Any = jnp.float32
 
     def setup(self) -> None:
-        self.norm = nn.LayerNorm()
+        self.norm = nn.LayerNorm(dtype=self.dtype, param_dtype=self.param_dtype)
         self.drop = nn.Dropout(
             self.dropout, broadcast_dims=[0], deterministic=not self.training
         )
-        self.dense_1 = nn.Dense(features=self.d_model)
-        self.dense_2 = nn.Dense(features=self.d_model)
+        self.dense_1 = nn.Dense(
+            features=self.d_model, dtype=self.dtype, param_dtype=self.param_dtype
+        )
+        self.dense_2 = nn.Dense(
+            features=self.d_model, dtype=self.dtype, param_dtype=self.param_dtype
+        )
 
+        layer_cls = remat(
+            SequenceBlock,
+            self.remat if self.training else "none",
+            "sequence_block",
+        )
         self.layers = [
-            SequenceBlock(
+            layer_cls(
                 layer=self.layer,
                 d_model=self.d_model,
                 dropout=self.dropout,
                 training=self.training,
                 rnn_mode=self.rnn_mode,
+                dtype=self.dtype,
+                param_dtype=self.param_dtype,
             )
             for _ in range(self.n_layers)
         ]
 
-    def __call__(self, x: jnp.ndarray) -> jnp.ndarray:
-        for layer in self.layers:
-            x = layer(x)
+    def __call__(
+        self, x: jnp.ndarray, drop_rates: Optional[jnp.ndarray] = None
+    ) -> jnp.ndarray:
+        for i, layer in enumerate(self.layers):
+            x = layer(x, None if drop_rates is None else drop_rates[i])
 
         skip = x
         x = self.norm(x)
@@ -89,38 +498,109 @@ class S4Block(nn.Module):
         return x
 
 
+class ScannedS4Block(S4Block):
+    """S4Block with the (carry, x) -> (carry, y) signature of nn.scan"""
+
+    def __call__(
+        self, x: jnp.ndarray, drop_rates: Optional[jnp.ndarray]
+    ) -> Tuple[jnp.ndarray, None]:
+        return super().__call__(x, drop_rates), None
+
+
 class SequenceBlock(nn.Module):
     layer: dict  # Hyperparameters of inner layer
     dropout: float
     d_model: int
     training: bool = True
     rnn_mode: bool = False
+    dtype: Any = jnp.float32
+    param_dtype: Any = jnp.float32
 
     def setup(self) -> None:
-        self.seq = S4Layer(**self.layer, rnn_mode=self.rnn_mode)
-        self.norm = nn.LayerNorm()
-        self.out = nn.Dense(self.d_model)
-        self.out2 = nn.Dense(self.d_model)
+        layer = dict(self.layer)
+        layer_cls = SSM_LAYERS[layer.pop("layer_type", "s4")]
+        assert "seq_axis_name" not in layer or getattr(
+            layer_cls, "sequence_parallel", False
+        ), f"{layer_cls.__name__} does not support a sharded sequence"
+        # Layers that are not cloned per feature are told the number of features, cloned
+        # convolutional layers resolve conv_mode "auto" with it
+        if any(
+            getattr(layer_cls, marker, False)
+            for marker in ("mimo", "channel_batched", "convolutional")
+        ):
+            layer["d_model"] = self.d_model
+        if not getattr(layer_cls, "convolutional", False):
+            # The shared layer config may carry the default conv_mode of convolutional layers
+            assert (
+                layer.pop("conv_mode", "auto") == "auto"
+            ), f"{layer_cls.__name__} has no causal convolution to set conv_mode for"
+        self.seq = layer_cls(**layer, rnn_mode=self.rnn_mode)
+        self.norm = nn.LayerNorm(dtype=self.dtype, param_dtype=self.param_dtype)
+        self.out = nn.Dense(
+            self.d_model, dtype=self.dtype, param_dtype=self.param_dtype
+        )
+        self.out2 = nn.Dense(
+            self.d_model, dtype=self.dtype, param_dtype=self.param_dtype
+        )
         self.drop = nn.Dropout(
             self.dropout,
             broadcast_dims=[0],
             deterministic=not self.training,
         )
 
-    def __call__(self, x: jnp.ndarray) -> jnp.ndarray:
-        skip = x
+    def residual(self, x: jnp.ndarray) -> jnp.ndarray:
         x = self.norm(x)
-        x = self.seq(x)
+        # The SSM always runs in float32, lower precision breaks the long range recurrence
+        x = self.seq(x.astype(jnp.float32)).astype(self.dtype)
         x = self.drop(nn.gelu(x))
         x = self.out(x) * jax.nn.sigmoid(self.out2(x))
-        x = skip + self.drop(x)
-        return x
+        return self.drop(x)
+
+    def __call__(
+        self, x: jnp.ndarray, drop_rate: Optional[jnp.ndarray] = None
+    ) -> jnp.ndarray:
+        if drop_rate is None or self.is_initializing():
+            return x + self.residual(x)
+
+        # Stochastic depth (Huang et al., 2016). The "drop_path" rng is shared by the batch
+        # (see S4Blocks), so the predicate is not batched and the dropped branch is skipped
+        # by lax.cond instead of computed and masked.
+        keep = jax.random.uniform(self.make_rng("drop_path")) >= drop_rate
+        return nn.cond(
+            keep,
+            lambda mdl, x, rate: x + mdl.residual(x) / (1.0 - rate),
+            lambda mdl, x, rate: x,
+            self,
+            x,
+            drop_rate,
+        )
 
 
 class S4Layer(nn.Module):
+    # Features of the enclosing block, resolves conv_mode "auto" in apply_kernel
+    d_model: int = 1
     N: int = 256
     l_max: int = 1
     rnn_mode: bool = False
+    # Frequencies per Cauchy block in kernel_DPLR, None evaluates all of them at once
+    cauchy_chunk_size: Optional[int] = None
+    # Keep one state of every conjugate pair, N // 2 states in total
+    conj_sym: bool = False
+    # Keep the kernel as its spectrum at the padded convolution length instead of in time
+    freq_kernel: bool = False
+    # RNN mode steps the DPLR factors in O(N) instead of a dense N x N Ab
+    structured_step: bool = False
+    # Causal convolution of CNN mode, see apply_kernel
+    conv_mode: ConvMode = "auto"
+    # Optional directory caching the HiPPO decomposition across runs, see cached_DPLR_HiPPO
+    hippo_cache_dir: Optional[str] = None
+    # Mesh axis the time axis is sharded over in CNN mode, see sequence_parallel
+    seq_axis_name: Optional[str] = None
+
+    # Applies a kernel with apply_kernel, SequenceBlock passes d_model
+    convolutional = True
+    # Supports seq_axis_name
+    sequence_parallel = True
 
     # Special parameters with multiplicative factor on lr and no weight decay (handled by main train script)
     lr = {
@@ -130,66 +610,378 @@ class S4Layer(nn.Module):
         "B": 0.1,
     }
 
+    def feature_shape(self) -> Tuple[int, ...]:
+        """Leading axes of the parameters and states, a single feature cloned by cloneLayer"""
+        return ()
+
+    def map_features(
+        self, fn: Callable, in_axes: Any = 0, out_axes: Any = 0
+    ) -> Callable:
+        """fn of the parameters of one feature applied to the features of the layer"""
+        return fn
+
     def setup(self) -> None:
+        self.n_states = self.N // 2 if self.conj_sym else self.N
+        features = self.feature_shape()
+        shape = features + (self.n_states,)
+
+        # The HiPPO initialisation is shared by all features
+        per_feature = lambda init: lambda key, shape: jnp.broadcast_to(
+            init(key, shape[len(features) :]), shape
+        )
+
         # Learned Parameters (C is complex!)
-        init_A_re, init_A_im, init_P, init_B = hippo_initializer(self.N)
-        self.Lambda_re = self.param("Lambda_re", init_A_re, (self.N,))
-        self.Lambda_im = self.param("Lambda_im", init_A_im, (self.N,))
+        init_A_re, init_A_im, init_P, init_B = map(
+            per_feature,
+            hippo_initializer(self.N, self.conj_sym, self.hippo_cache_dir),
+        )
+        self.Lambda_re = self.param("Lambda_re", init_A_re, shape)
+        self.Lambda_im = self.param("Lambda_im", init_A_im, shape)
 
         self.Lambda = jnp.clip(self.Lambda_re, None, -1e-4) + 1j * self.Lambda_im
-        self.P = self.param("P", init_P, (self.N,))
-        self.B = self.param("B", init_B, (self.N,))
+        self.P = self.param("P", init_P, shape)
+        self.B = self.param("B", init_B, shape)
 
-        self.C = self.param("C", normal(stddev=0.5**0.5), (self.N, 2))
+        self.C = self.param("C", normal(stddev=0.5**0.5), shape + (2,))
         self.C = self.C[..., 0] + 1j * self.C[..., 1]
-        self.D = self.param("D", nn.initializers.ones, (1,))
-        self.step = jnp.exp(self.param("log_step", log_step_initializer(), (1,)))
+        self.D = self.param("D", nn.initializers.ones, features or (1,))
+        self.step = jnp.exp(
+            self.param("log_step", log_step_initializer(), features or (1,))
+        )
 
         if not self.rnn_mode:
-            self.K = kernel_DPLR(
-                self.Lambda,
-                self.P,
-                self.P,
-                self.B,
-                self.C,
-                self.step,
-                self.l_max,
-            )
+            # Inputs of up to l_max steps fit in a circular convolution of length 2 * l_max
+            self.fft_len = 2 * self.l_max
+            self.K = frozen_kernel(self, lambda: self.kernel(self.B, self.freq_kernel))
+            self.x_0 = cnn_state(self, shape)
         else:
             # Flax trick to cache discrete form during decoding.
             def init_discrete():
-                return discrete_DPLR(
+                discretize = (
+                    discrete_DPLR_factors if self.structured_step else discrete_DPLR
+                )
+                return self.map_features(
+                    partial(discretize, L=self.l_max, conj_sym=self.conj_sym)
+                )(self.Lambda, self.P, self.P, self.B, self.C, self.step)
+
+            self.x_k_1 = self.variable(
+                "cache",
+                "cache_x_k",
+                lambda: jnp.zeros(shape, dtype=jnp.complex64),
+            )
+
+            ssm_var = self.variable("prime", "ssm", init_discrete)
+            if self.is_mutable_collection("prime"):
+                ssm_var.value = init_discrete()
+                self.x_k_1.value = jnp.zeros(shape, dtype=jnp.complex64)
+            self.ssm = ssm_var.value
+
+    def kernel(self, B: jnp.ndarray, freq: bool = False) -> jnp.ndarray:
+        """kernel_DPLR of the features with input matrix B, (l_max, *features), or its
+        spectrum at fft_len with freq set
+        """
+
+        def kernel(Lambda, P, B, C, step):
+            return kernel_DPLR(
+                Lambda,
+                P,
+                P,
+                B,
+                C,
+                step,
+                self.l_max,
+                self.cauchy_chunk_size,
+                self.conj_sym,
+                self.fft_len if freq else None,
+            )
+
+        return self.map_features(kernel, out_axes=-1)(
+            self.Lambda, self.P, B, self.C, self.step
+        )
+
+    def __call__(self, u: jnp.ndarray) -> jnp.ndarray:
+        if not self.rnn_mode:
+            # CNN Mode - paralell forward pass
+            assert u.shape[0] <= self.l_max, "Sequence is longer than the S4 kernel"
+            y = apply_kernel(
+                u, self.K, self.D, self.conv_mode, self.freq_kernel, self.d_model
+            )
+            # Per feature u is (l), the states are mapped over the leading feature axes
+            feature_axes = (0, 0, 0, 0, -1, 0)
+
+            def final_state(Lambda, P, B, step, u, x_0):
+                ssm = discrete_DPLR_step(Lambda, P, P, B, step, self.conj_sym)
+                return final_state_DPLR(ssm, u, x_0, self.conj_sym)
+
+            x_0 = None if self.x_0 is None else self.x_0.value
+            x_L = None
+            if self.seq_axis_name is not None and not self.is_initializing():
+                # The local chunk starts from the final state of the preceding chunks
+                def chunk_states(Lambda, P, B, step, u, x_0):
+                    ssm = discrete_DPLR_step(Lambda, P, P, B, step, self.conj_sym)
+                    x_chunk = final_state_DPLR(
+                        ssm, u, jnp.zeros_like(Lambda), self.conj_sym
+                    )
+                    return pass_chunk_states(
+                        x_chunk,
+                        lambda x: propagate_DPLR(ssm, x, u.shape[0], self.conj_sym),
+                        x_0,
+                        self.seq_axis_name,
+                    )
+
+                x_0, x_L = self.map_features(chunk_states, feature_axes)(
+                    self.Lambda, self.P, self.B, self.step, u, x_0
+                )
+
+            if x_0 is not None:
+                # Add the response to the initial state and store the final state
+                B_0 = self.map_features(
+                    partial(initial_state_DPLR, conj_sym=self.conj_sym)
+                )(self.Lambda, self.P, self.P, self.step, x_0)
+                y = y + self.kernel(B_0)[: u.shape[0]]
+                if self.x_0 is not None and self.is_mutable_collection("cache"):
+                    if x_L is None:
+                        x_L = self.map_features(final_state, feature_axes)(
+                            self.Lambda, self.P, self.B, self.step, u, x_0
+                        )
+                    self.x_0.value = x_L
+            return y
+        else:
+            # RNN Mode - sequential forward pass, every feature is stepped by its own SSM
+            def scan(ssm, u, x_0):
+                if self.structured_step:
+                    x_k, y_s = scan_SSM_DPLR(ssm, u, x_0, self.conj_sym)
+                else:
+                    x_k, y_s = scan_SSM(*ssm, u[:, jnp.newaxis], x_0, self.conj_sym)
+                return x_k, y_s.reshape(-1).real
+
+            x_k, y_s = self.map_features(scan, (0, -1, 0), (0, -1))(
+                self.ssm, u, self.x_k_1.value
+            )
+            if self.is_mutable_collection("cache") and not self.is_mutable_collection(
+                "prime"
+            ):
+                self.x_k_1.value = x_k
+            return y_s + self.D * u
+
+
+class S4DLayer(nn.Module):
+    # Features of the enclosing block, resolves conv_mode "auto" in apply_kernel
+    d_model: int = 1
+    N: int = 256
+    l_max: int = 1
+    rnn_mode: bool = False
+    # Keep the kernel as its spectrum at the padded convolution length instead of in time
+    freq_kernel: bool = False
+    # Optional directory caching the HiPPO decomposition across runs, see cached_DPLR_HiPPO
+    hippo_cache_dir: Optional[str] = None
+    # Causal convolution of CNN mode, see apply_kernel
+    conv_mode: ConvMode = "auto"
+    # Mesh axis the time axis is sharded over in CNN mode, see sequence_parallel
+    seq_axis_name: Optional[str] = None
+
+    # Applies a kernel with apply_kernel, SequenceBlock passes d_model
+    convolutional = True
+    # Supports seq_axis_name
+    sequence_parallel = True
+
+    # Special parameters with multiplicative factor on lr and no weight decay (handled by main train script)
+    lr = {
+        "Lambda_re": 0.1,
+        "Lambda_im": 0.1,
+        "B": 0.1,
+    }
+
+    def setup(self) -> None:
+        # Diagonal of the DPLR HiPPO matrix (S4D-LegS), one state of every conjugate pair
+        self.n_states = self.N // 2
+        init_A_re, init_A_im, _, init_B = hippo_initializer(
+            self.N, conj_sym=True, cache_dir=self.hippo_cache_dir
+        )
+        self.Lambda_re = self.param("Lambda_re", init_A_re, (self.n_states,))
+        self.Lambda_im = self.param("Lambda_im", init_A_im, (self.n_states,))
+
+        self.Lambda = jnp.clip(self.Lambda_re, None, -1e-4) + 1j * self.Lambda_im
+        self.B = self.param("B", init_B, (self.n_states,))
+
+        self.C = self.param("C", normal(stddev=0.5**0.5), (self.n_states, 2))
+        self.C = self.C[..., 0] + 1j * self.C[..., 1]
+        self.D = self.param("D", nn.initializers.ones, (1,))
+        self.step = jnp.exp(self.param("log_step", log_step_initializer(), (1,)))
+
+        if not self.rnn_mode:
+            self.fft_len = 2 * self.l_max
+            self.K = frozen_kernel(
+                self,
+                lambda: kernel_S4D(
                     self.Lambda,
-                    self.P,
-                    self.P,
                     self.B,
                     self.C,
                     self.step,
                     self.l_max,
-                )
+                    self.fft_len if self.freq_kernel else None,
+                ),
+            )
+            self.x_0 = cnn_state(self, (self.n_states,))
+        else:
+            # Flax trick to cache discrete form during decoding.
+            def init_discrete():
+                return discrete_S4D(self.Lambda, self.B, self.C, self.step)
 
             self.x_k_1 = self.variable(
-                "cache", "cache_x_k", lambda: jnp.zeros((self.N,), dtype=jnp.complex64)
+                "cache",
+                "cache_x_k",
+                lambda: jnp.zeros((self.n_states,), dtype=jnp.complex64),
             )
 
             ssm_var = self.variable("prime", "ssm", init_discrete)
             if self.is_mutable_collection("prime"):
                 ssm_var.value = init_discrete()
-                self.x_k_1.value = jnp.zeros((self.N,), dtype=jnp.complex64)
+                self.x_k_1.value = jnp.zeros((self.n_states,), dtype=jnp.complex64)
             self.ssm = ssm_var.value
 
     def __call__(self, u: jnp.ndarray) -> jnp.ndarray:
         if not self.rnn_mode:
             # CNN Mode - paralell forward pass
-            return causal_convolution(u, self.K) + self.D * u
+            assert u.shape[0] <= self.l_max, "Sequence is longer than the S4 kernel"
+            y = apply_kernel(
+                u, self.K, self.D, self.conv_mode, self.freq_kernel, self.d_model
+            )
+
+            if self.seq_axis_name is not None and not self.is_initializing():
+                # The local chunk starts from the final state of the preceding chunks
+                ssm = discrete_S4D(self.Lambda, self.B, self.C, self.step)
+                x_chunk, _ = prefill_S4D(
+                    ssm, u, jnp.zeros((self.n_states,), jnp.complex64)
+                )
+                Lambda_bar_L = ssm[0] ** u.shape[0]
+                x_0, x_L = pass_chunk_states(
+                    x_chunk,
+                    lambda x: Lambda_bar_L * x,
+                    None if self.x_0 is None else self.x_0.value,
+                    self.seq_axis_name,
+                )
+                _, y_0 = prefill_S4D(ssm, u, x_0)
+                y = y + y_0
+                if self.x_0 is not None and self.is_mutable_collection("cache"):
+                    self.x_0.value = x_L
+            elif self.x_0 is not None:
+                # Add the response to the initial state and store the final state
+                ssm = discrete_S4D(self.Lambda, self.B, self.C, self.step)
+                x_k, y_0 = prefill_S4D(ssm, u, self.x_0.value)
+                y = y + y_0
+                if self.is_mutable_collection("cache"):
+                    self.x_0.value = x_k
+            return y
         else:
             # RNN Mode - sequential forward pass
-            x_k, y_s = scan_SSM(*self.ssm, u[:, jnp.newaxis], self.x_k_1.value)
+            x_k, y_s = scan_SSM_diag(self.ssm, u, self.x_k_1.value)
             if self.is_mutable_collection("cache") and not self.is_mutable_collection(
                 "prime"
             ):
                 self.x_k_1.value = x_k
-            return y_s.reshape(-1).real + self.D * u
+            return y_s.real + self.D * u
+
+
+class S5Layer(nn.Module):
+    d_model: int
+    N: int = 256
+    l_max: int = 1
+    rnn_mode: bool = False
+    # Optional directory caching the HiPPO decomposition across runs, see cached_DPLR_HiPPO
+    hippo_cache_dir: Optional[str] = None
+
+    # Mixes all d_model features with one state space instead of being cloned per feature
+    mimo = True
+
+    # Special parameters with multiplicative factor on lr and no weight decay (handled by main train script)
+    lr = {
+        "Lambda_re": 0.1,
+        "Lambda_im": 0.1,
+        "B": 0.1,
+    }
+
+    def setup(self) -> None:
+        # Diagonal of the DPLR HiPPO matrix, one state of every conjugate pair
+        self.n_states = self.N // 2
+        init_A_re, init_A_im, _, _ = hippo_initializer(
+            self.N, conj_sym=True, cache_dir=self.hippo_cache_dir
+        )
+        self.Lambda_re = self.param("Lambda_re", init_A_re, (self.n_states,))
+        self.Lambda_im = self.param("Lambda_im", init_A_im, (self.n_states,))
+        self.Lambda = jnp.clip(self.Lambda_re, None, -1e-4) + 1j * self.Lambda_im
+
+        self.B = self.param(
+            "B",
+            normal(stddev=(0.5 / self.d_model) ** 0.5),
+            (self.n_states, self.d_model, 2),
+        )
+        self.B = self.B[..., 0] + 1j * self.B[..., 1]
+        self.C = self.param(
+            "C",
+            normal(stddev=(0.5 / self.n_states) ** 0.5),
+            (self.d_model, self.n_states, 2),
+        )
+        self.C = self.C[..., 0] + 1j * self.C[..., 1]
+        self.D = self.param("D", nn.initializers.ones, (self.d_model,))
+        self.step = jnp.exp(
+            self.param("log_step", log_step_initializer(), (self.n_states,))
+        )
+
+        def init_discrete():
+            return discrete_S5(self.Lambda, self.B, self.step)
+
+        if not self.rnn_mode:
+            self.ssm = init_discrete()
+            self.x_k_1 = cnn_state(self, (self.n_states,))
+        else:
+            # Flax trick to cache discrete form during decoding.
+            self.x_k_1 = self.variable(
+                "cache",
+                "cache_x_k",
+                lambda: jnp.zeros((self.n_states,), dtype=jnp.complex64),
+            )
+
+            ssm_var = self.variable("prime", "ssm", init_discrete)
+            if self.is_mutable_collection("prime"):
+                ssm_var.value = init_discrete()
+                self.x_k_1.value = jnp.zeros((self.n_states,), dtype=jnp.complex64)
+            self.ssm = ssm_var.value
+
+    def __call__(self, u: jnp.ndarray) -> jnp.ndarray:
+        # The same parallel scan is used in CNN and RNN mode, only the initial state differs
+        Lambda_bar, B_bar = self.ssm
+        if self.x_k_1 is None:
+            x0 = jnp.zeros((self.n_states,), dtype=jnp.complex64)
+        else:
+            x0 = self.x_k_1.value
+
+        xs = scan_SSM_assoc(Lambda_bar, u @ B_bar.T, x0)
+        if (
+            self.x_k_1 is not None
+            and self.is_mutable_collection("cache")
+            and not self.is_mutable_collection("prime")
+        ):
+            self.x_k_1.value = xs[-1]
+        return 2 * (xs @ self.C.T).real + self.D * u
+
+
+class S4BatchedLayer(S4Layer):
+    """S4Layer over all d_model features at once, with (d_model, N) parameters instead of a
+    per feature layer cloned by cloneLayer. The kernels and the discretisation are mapped
+    over the features as plain functions and the convolution is a single batched FFT.
+    """
+
+    # Holds all features itself, the parameters convert with S4_params_to_batched
+    channel_batched = True
+
+    def feature_shape(self) -> Tuple[int, ...]:
+        return (self.d_model,)
+
+    def map_features(
+        self, fn: Callable, in_axes: Any = 0, out_axes: Any = 0
+    ) -> Callable:
+        return jax.vmap(fn, in_axes=in_axes, out_axes=out_axes)
 
 
 def cloneLayer(layer):
@@ -203,11 +995,192 @@ def cloneLayer(layer):
 
 
 S4Layer = cloneLayer(S4Layer)
+S4DLayer = cloneLayer(S4DLayer)
+
+# Sequence layers selectable through the "layer_type" entry of the layer config
+SSM_LAYERS = {
+    "s4": S4Layer,
+    "s4d": S4DLayer,
+    "s5": S5Layer,
+    "s4_batched": S4BatchedLayer,
+}
+
+# Parameters of an S4 layer, with the features on axis 1 when cloned and on axis 0 when batched
+_S4_PARAMS = {"Lambda_re", "Lambda_im", "P", "B", "C", "D", "log_step"}
+
+
+def _map_S4_params(params: Dict, fn: Callable) -> Dict:
+    if set(params.keys()) == _S4_PARAMS:
+        return {k: fn(k, v) for k, v in params.items()}
+    return {
+        k: (_map_S4_params(v, fn) if hasattr(v, "keys") else v)
+        for k, v in params.items()
+    }
+
+
+def _assert_unstacked(name: str, x: jnp.ndarray, ndim: int) -> None:
+    # The blocks of scan_blocks stack the parameters on a leading axis
+    assert x.ndim == ndim + (name == "C"), (
+        f"{name} has shape {x.shape}, convert scanned blocks with S4Blocks_to_unrolled "
+        "first"
+    )
+
+
+def S4_params_to_batched(params: Dict) -> Dict:
+    """Convert a params tree with cloned S4Layers (layer_type "s4") to S4BatchedLayers
+    (layer_type "s4_batched"), e.g. to restore an existing checkpoint into the batched layer.
+    The blocks have to be unrolled, see S4Blocks_to_unrolled.
+    """
+
+    def to_batched(name: str, x: jnp.ndarray) -> jnp.ndarray:
+        _assert_unstacked(name, x, 2)
+        x = jnp.moveaxis(x, 1, 0)
+        return x.reshape(-1) if name in ("D", "log_step") else x
+
+    return _map_S4_params(params, to_batched)
+
+
+def S4_params_to_cloned(params: Dict) -> Dict:
+    """Inverse of S4_params_to_batched"""
+
+    def to_cloned(name: str, x: jnp.ndarray) -> jnp.ndarray:
+        _assert_unstacked(name, x, 1 if name in ("D", "log_step") else 2)
+        if name in ("D", "log_step"):
+            return x[jnp.newaxis, :]
+        return jnp.moveaxis(x, 0, 1)
+
+    return _map_S4_params(params, to_cloned)
+
+
+def _map_SSM_layers(params: Dict, fn: Callable) -> Dict:
+    if "Lambda_re" in params and "C" in params:
+        return fn(params)
+    return {
+        k: (_map_SSM_layers(v, fn) if hasattr(v, "keys") else v)
+        for k, v in params.items()
+    }
+
+
+def _channel_kernel(
+    params: Dict, mask: jnp.ndarray, L: int, conj_sym: bool
+) -> jnp.ndarray:
+    """Kernel of one channel of an S4 or S4D layer with the states outside of mask removed"""
+    Lambda = jnp.clip(params["Lambda_re"], None, -1e-4) + 1j * params["Lambda_im"]
+    B = params["B"] * mask
+    C = (params["C"][..., 0] + 1j * params["C"][..., 1]) * mask
+    step = jnp.exp(params["log_step"][0])
+    if "P" in params:
+        P = params["P"] * mask
+        return kernel_DPLR(Lambda, P, P, B, C, step, L, conj_sym=conj_sym)
+    return kernel_S4D(Lambda, B, C, step, L)
+
+
+@partial(jax.jit, static_argnums=(1, 2))
+def S4_mode_scores(params: Dict, L: int, conj_sym: bool = False) -> jnp.ndarray:
+    """Squared change of the length L kernel of every channel of an S4 or S4D layer (cloned
+    layout, features on axis 1) when one of its states is removed, (n_states, d_model).
+    Without its entries in B, C and P a state is decoupled from the DPLR system, so the
+    score is exact for the removal of a single state.
+    """
+
+    def channel(params: Dict) -> jnp.ndarray:
+        n_states = params["Lambda_re"].shape[0]
+        K = _channel_kernel(params, jnp.ones(n_states), L, conj_sym)
+        return jax.lax.map(
+            lambda mask: jnp.sum((K - _channel_kernel(params, mask, L, conj_sym)) ** 2),
+            1.0 - jnp.eye(n_states),
+        )
+
+    return jax.vmap(channel, in_axes=1, out_axes=1)(params)
+
+
+def truncate_S4_params(
+    params: Dict, n_states: int, L: int, conj_sym: bool = False
+) -> Dict:
+    """Modal truncation of every S4 and S4D layer (layer_type "s4" or "s4d") in params to the
+    n_states states per channel that contribute most to its length L kernel, see
+    S4_mode_scores. The reduced layers have N = n_states, or N = 2 * n_states when only one
+    state of every conjugate pair is stored (conj_sym and S4D).
+    """
+
+    def truncate(layer: Dict) -> Dict:
+        scores = S4_mode_scores(layer, L, conj_sym)
+        keep = jnp.sort(jnp.argsort(-scores, axis=0)[:n_states], axis=0)
+
+        def take(name: str, x: jnp.ndarray) -> jnp.ndarray:
+            if name in ("D", "log_step"):
+                return x
+            idx = keep if x.ndim == 2 else keep[..., jnp.newaxis]
+            return jnp.take_along_axis(x, idx, axis=0)
+
+        return {k: take(k, v) for k, v in layer.items()}
+
+    return _map_SSM_layers(params, truncate)
+
+
+def _map_S4Blocks(variables: Dict, fn: Callable) -> Dict:
+    # Stacks nest, e.g. the coarse blocks of PooledS4Blocks
+    variables = {
+        k: (
+            _map_S4Blocks(v, fn)
+            if hasattr(v, "keys") and not k.startswith("blocks")
+            else v
+        )
+        for k, v in variables.items()
+    }
+    if "blocks_0" in variables or "blocks" in variables:
+        return fn(variables)
+    return variables
+
+
+def S4Blocks_to_scanned(variables: Dict, axis: int = 0) -> Dict:
+    """Convert a collection of unrolled S4Blocks (blocks_0, blocks_1, ...) to the layout of
+    scan_blocks, with the blocks stacked along axis. The stacked axis is 0 for "params" and
+    "prime", and 1 for "cache", which has the batch on axis 0.
+    """
+
+    def stack(blocks: Dict) -> Dict:
+        n_blocks = sum(k.startswith("blocks_") for k in blocks)
+        stacked = jax.tree_util.tree_map(
+            lambda *xs: jnp.stack(xs, axis=axis),
+            *[blocks[f"blocks_{i}"] for i in range(n_blocks)],
+        )
+        rest = {k: v for k, v in blocks.items() if not k.startswith("blocks_")}
+        return {**rest, "blocks": stacked}
+
+    return _map_S4Blocks(variables, stack)
+
+
+def S4Blocks_to_unrolled(variables: Dict, axis: int = 0) -> Dict:
+    """Inverse of S4Blocks_to_scanned"""
+
+    def unstack(blocks: Dict) -> Dict:
+        n_blocks = jax.tree_util.tree_leaves(blocks["blocks"])[0].shape[axis]
+        rest = {k: v for k, v in blocks.items() if k != "blocks"}
+        for i in range(n_blocks):
+            rest[f"blocks_{i}"] = jax.tree_util.tree_map(
+                lambda x: jnp.take(x, i, axis=axis), blocks["blocks"]
+            )
+        return rest
+
+    return _map_S4Blocks(variables, unstack)
+
+
+def reset_RNN_cache(cache: Dict, batch_idx: jnp.ndarray) -> Dict:
+    """Zero the RNN mode cache of the sequences batch_idx, e.g. of environments starting a
+    new episode. The "phase" of PooledS4Blocks is shared by the batch and kept.
+    """
+    return jax.tree_util.tree_map_with_path(
+        lambda path, x: x if path[-1].key == "phase" else x.at[batch_idx].set(0),
+        cache,
+    )
+
 
 S4Blocks = nn.vmap(
     S4Blocks,
     in_axes=0,
     out_axes=0,
+    axis_name=BATCH_AXIS,
     variable_axes={"params": None, "dropout": None, "cache": 0, "prime": None},
-    split_rngs={"params": False, "dropout": True},
+    split_rngs={"params": False, "dropout": True, "drop_path": False},
 )
@@ -1,8 +1,13 @@
+import os
 import jax
+import numpy as np
 import jax.numpy as jnp
 
-from jax.numpy.linalg import eigh, inv, matrix_power
-from typing import Callable
+from functools import lru_cache, partial
+from jax.numpy.linalg import eigh
+from typing import Callable, Literal, Optional, Tuple
+
+ConvMode = Literal["auto", "fft", "direct"]
 
 
 def log_step_initializer(dt_min: float = 0.001, dt_max: float = 0.1) -> Callable:
@@ -14,24 +19,179 @@ def log_step_initializer(dt_min: float = 0.001, dt_max: float = 0.1) -> Callable
     return init
 
 
+def conj_pair(x: jnp.ndarray) -> jnp.ndarray:
+    """Restore the conjugate pairs of a conjugate symmetric system: (n) -> (2n)"""
+    return jnp.concatenate((x, x.conj()))
+
+
 def scan_SSM(
-    Ab: jnp.ndarray, Bb: jnp.ndarray, Cb: jnp.ndarray, u: jnp.ndarray, x0: jnp.ndarray
+    Ab: jnp.ndarray,
+    Bb: jnp.ndarray,
+    Cb: jnp.ndarray,
+    u: jnp.ndarray,
+    x0: jnp.ndarray,
+    conj_sym: bool = False,
 ) -> jnp.ndarray:
 
     def step(x_k_1, u_k):
-        x_k = Ab @ x_k_1 + Bb @ u_k
-        y_k = Cb @ x_k
+        if conj_sym:
+            # Only one state of every conjugate pair is kept, the full state is (x, x*)
+            x_k = Ab @ conj_pair(x_k_1) + Bb @ u_k
+            y_k = 2 * Cb @ x_k
+        else:
+            x_k = Ab @ x_k_1 + Bb @ u_k
+            y_k = Cb @ x_k
+
+        return x_k, y_k
+
+    return jax.lax.scan(step, x0, u)
+
+
+def step_DPLR(
+    ssm: Tuple[jnp.ndarray, ...], x: jnp.ndarray, u: jnp.ndarray, conj_sym: bool = False
+) -> jnp.ndarray:
+    """One step of the bilinear discretisation Ab = A1 A0 applied in DPLR form, O(N)"""
+    A0, D, P, Q, r, Bb = ssm[:6]
+    n = x.shape[0]
+    if conj_sym:
+        A0, D, P, Q, x = map(conj_pair, (A0, D, P, Q, x))
+
+    # Forward Euler, A0 x = (2 / step + Lambda) x - P Q* x
+    y = A0 * x - P * (Q.conj() @ x)
+
+    # Backward Euler, A1 y = D y - r D P Q* D y
+    Dy = D * y
+    x_k = Dy - (r * (Q.conj() @ Dy)) * (D * P)
+    return x_k[:n] + Bb * u
+
+
+def scan_SSM_DPLR(
+    ssm: Tuple[jnp.ndarray, ...],
+    u: jnp.ndarray,
+    x0: jnp.ndarray,
+    conj_sym: bool = False,
+) -> jnp.ndarray:
+    """scan_SSM for the factors of discrete_DPLR_factors: (l), (n) -> (n), (l)"""
+    Cb = ssm[-1]
 
+    def step(x_k_1, u_k):
+        x_k = step_DPLR(ssm, x_k_1, u_k, conj_sym)
+        y_k = (2 if conj_sym else 1) * Cb @ x_k
         return x_k, y_k
 
     return jax.lax.scan(step, x0, u)
 
 
+def final_state_DPLR(
+    ssm: Tuple[jnp.ndarray, ...],
+    u: jnp.ndarray,
+    x0: jnp.ndarray,
+    conj_sym: bool = False,
+) -> jnp.ndarray:
+    """Final state of scan_SSM_DPLR, x_L = Ab^L x0 + sum_k Ab^(L-1-k) Bb u_k: (l), (n) -> (n)
+    The Krylov vectors Ab^k Bb do not depend on the input, so under a vmap over the batch
+    they are generated once and the input only enters through a matrix product.
+    """
+    Bb = ssm[5]
+
+    def step(carry, _):
+        krylov, x = carry
+        carry = (
+            step_DPLR(ssm, krylov, 0.0, conj_sym),
+            step_DPLR(ssm, x, 0.0, conj_sym),
+        )
+        return carry, krylov
+
+    (_, x_L), krylov = jax.lax.scan(step, (Bb, x0), None, length=u.shape[0])
+    return x_L + krylov[::-1].T @ u
+
+
+def initial_state_DPLR(
+    Lambda: jnp.ndarray,
+    P: jnp.ndarray,
+    Q: jnp.ndarray,
+    step: float,
+    x0: jnp.ndarray,
+    conj_sym: bool = False,
+) -> jnp.ndarray:
+    """Input vector B' with Bb' = 2 A1 B' = Ab x0, i.e. B' = A0 x0 / 2. The kernel_DPLR of B'
+    is the response of the output to the initial state, y_k = C Ab^k Bb' = C Ab^(k+1) x0.
+    """
+    n = x0.shape[0]
+    if conj_sym:
+        Lambda, P, Q, x0 = map(conj_pair, (Lambda, P, Q, x0))
+
+    A0x = ((2.0 / step) + Lambda) * x0 - P * (Q.conj() @ x0)
+    return A0x[:n] / 2.0
+
+
 def causal_convolution(u: jnp.ndarray, K: jnp.ndarray) -> jnp.ndarray:
-    ud = jnp.fft.rfft(jnp.pad(u, (0, K.shape[0])))
-    Kd = jnp.fft.rfft(jnp.pad(K, (0, u.shape[0])))
+    """Causal convolution along the first axis: (l, ...), (l_max, ...) -> (l, ...)"""
+    # irfft needs the length explicitly, it can be odd when u is shorter than the kernel
+    n = u.shape[0] + K.shape[0]
+    ud = jnp.fft.rfft(u, n=n, axis=0)
+    Kd = jnp.fft.rfft(K, n=n, axis=0)
     out = ud * Kd
-    return jnp.fft.irfft(out)[: u.shape[0]]
+    return jnp.fft.irfft(out, n=n, axis=0)[: u.shape[0]]
+
+
+def causal_convolution_direct(u: jnp.ndarray, K: jnp.ndarray) -> jnp.ndarray:
+    """Causal convolution as a matmul with the lower triangular Toeplitz matrix of K. For
+    short sequences this beats the FFT, the Toeplitz matrix only depends on the kernel and
+    is shared by all sequences of a batch: (l, ...), (l_max, ...) -> (l, ...)
+    """
+    L = u.shape[0]
+    lags = jnp.arange(L)[:, jnp.newaxis] - jnp.arange(L)[jnp.newaxis, :]
+    causal = (lags >= 0).reshape(lags.shape + (1,) * (K.ndim - 1))
+    T = jnp.where(causal, K[jnp.clip(lags, 0, None)], 0.0)
+    return jnp.einsum("ij...,j...->i...", T, u)
+
+
+def causal_convolution_freq(u: jnp.ndarray, K_f: jnp.ndarray, n: int) -> jnp.ndarray:
+    """Causal convolution with a kernel given by its rfft at padded length n (see kernel_DPLR)"""
+    ud = jnp.fft.rfft(u, n=n, axis=0)
+    return jnp.fft.irfft(ud * K_f, n=n, axis=0)[: u.shape[0]]
+
+
+# Longest sequence for which the direct convolution beats the FFT, as (max d_model, max l)
+# per platform, measured with benchmark_ssm.benchmark_convolution at batch sizes 1 and 8.
+# Platforms without an entry always use the FFT.
+DIRECT_CONV_MAX_LEN = {
+    "cpu": ((256, 48), (1024, 32)),
+}
+
+
+def select_conv_mode(seq_len: int, d_model: int) -> ConvMode:
+    """Resolve conv_mode "auto" for the current platform from DIRECT_CONV_MAX_LEN"""
+    for max_d_model, max_len in DIRECT_CONV_MAX_LEN.get(jax.default_backend(), ()):
+        if d_model <= max_d_model:
+            return "direct" if seq_len <= max_len else "fft"
+    return "fft"
+
+
+def apply_kernel(
+    u: jnp.ndarray,
+    K: jnp.ndarray,
+    D: jnp.ndarray,
+    conv_mode: ConvMode,
+    freq_kernel: bool,
+    d_model: int = 1,
+) -> jnp.ndarray:
+    """Output of an SSM convolution kernel K with skip term D: (l, ...) -> (l, ...). K is
+    the spectrum at fft_len = 2 * l_max with freq_kernel set. conv_mode "auto" is resolved
+    from the length of u, which is static under jit, for d_model features.
+    """
+    if freq_kernel:
+        assert conv_mode != "direct", "A frequency domain kernel needs the FFT"
+        y = causal_convolution_freq(u, K, 2 * (K.shape[0] - 1))
+    else:
+        if conv_mode == "auto":
+            conv_mode = select_conv_mode(u.shape[0], d_model)
+        if conv_mode == "direct":
+            y = causal_convolution_direct(u, K)
+        else:
+            y = causal_convolution(u, K)
+    return y + D * u
 
 
 def make_HiPPO(N: jnp.ndarray) -> jnp.ndarray:
@@ -47,6 +207,57 @@ def cauchy(v: jnp.ndarray, omega: jnp.ndarray, lambd: jnp.ndarray) -> jnp.ndarra
     return jax.vmap(cauchy_dot)(omega)
 
 
+def _chunk(x: jnp.ndarray, chunk_size: int) -> jnp.ndarray:
+    """Zero pad (l) to a multiple of chunk_size and split it into (l // chunk_size, chunk_size)"""
+    return jnp.pad(x, (0, -x.shape[0] % chunk_size)).reshape(-1, chunk_size)
+
+
+@partial(jax.custom_vjp, nondiff_argnums=(3,))
+def cauchy_chunked(
+    v: jnp.ndarray, omega: jnp.ndarray, lambd: jnp.ndarray, chunk_size: int
+) -> jnp.ndarray:
+    """Cauchy matrix multiplication over blocks of chunk_size frequencies: (n), (l), (n) -> (l)
+
+    Only a (chunk_size, n) intermediate is live at any time, in the primal as well as in the
+    gradient, instead of the full (l, n) matrix built by `cauchy`.
+    """
+    out = jax.lax.map(
+        lambda _omega: cauchy(v, _omega, lambd), _chunk(omega, chunk_size)
+    )
+    return out.reshape(-1)[: omega.shape[0]]
+
+
+def _cauchy_chunked_fwd(v, omega, lambd, chunk_size):
+    return cauchy_chunked(v, omega, lambd, chunk_size), (v, omega, lambd)
+
+
+def _cauchy_chunked_bwd(chunk_size, res, g):
+    v, omega, lambd = res
+
+    def step(carry, chunk):
+        v_bar, lambd_bar = carry
+        _omega, _g = chunk
+        r = 1.0 / (_omega[:, jnp.newaxis] - lambd)  # (chunk_size, n)
+        gr = _g[:, jnp.newaxis] * r
+        grr = gr * r
+        omega_bar = -(grr * v).sum(-1)
+        return (v_bar + gr.sum(0), lambd_bar + grr.sum(0) * v), omega_bar
+
+    # Padded frequencies carry a zero cotangent and do not contribute to the sums
+    (v_bar, lambd_bar), omega_bar = jax.lax.scan(
+        step,
+        (jnp.zeros_like(v, dtype=g.dtype), jnp.zeros_like(lambd, dtype=g.dtype)),
+        (_chunk(omega, chunk_size), _chunk(g, chunk_size)),
+    )
+    omega_bar = omega_bar.reshape(-1)[: omega.shape[0]]
+
+    _like = lambda x, ref: x if jnp.iscomplexobj(ref) else x.real
+    return _like(v_bar, v), _like(omega_bar, omega), _like(lambd_bar, lambd)
+
+
+cauchy_chunked.defvjp(_cauchy_chunked_fwd, _cauchy_chunked_bwd)
+
+
 def kernel_DPLR(
     Lambda: jnp.ndarray,
     P: jnp.ndarray,
@@ -55,25 +266,53 @@ def kernel_DPLR(
     C: jnp.ndarray,
     step: float,
     L: int,
+    chunk_size: Optional[int] = None,
+    conj_sym: bool = False,
+    fft_len: Optional[int] = None,
 ) -> jnp.ndarray:
+    """Convolution kernel of length L of the DPLR SSM, or with fft_len set, the rfft of the
+    kernel zero padded to fft_len, ready to be multiplied with the spectrum of the input.
+    """
     # Evaluate at roots of unity
     # Generating function is (-)z-transform, so we evaluate at (-)root
-    Omega_L = jnp.exp((-2j * jnp.pi) * (jnp.arange(L) / L))
+    # A conjugate symmetric system has a real kernel, so half of the spectrum is enough
+    n_freqs = L // 2 + 1 if conj_sym else L
+    Omega_L = jnp.exp((-2j * jnp.pi) * (jnp.arange(n_freqs) / L))
 
     aterm = (C.conj(), Q.conj())
     bterm = (B, P)
 
+    if conj_sym:
+        # Restore the conjugate pairs that are not stored
+        aterm, bterm = tuple(map(conj_pair, aterm)), tuple(map(conj_pair, bterm))
+        Lambda = conj_pair(Lambda)
+
     g = (2.0 / step) * ((1.0 - Omega_L) / (1.0 + Omega_L))
     c = 2.0 / (1.0 + Omega_L)
 
+    # Bound the (L, N) Cauchy intermediates by evaluating chunk_size frequencies at a time
+    if chunk_size:
+        _cauchy = lambda v, omega, lambd: cauchy_chunked(v, omega, lambd, chunk_size)
+    else:
+        _cauchy = cauchy
+
     # Reduction to core Cauchy kernel
-    k00 = cauchy(aterm[0] * bterm[0], g, Lambda)
-    k01 = cauchy(aterm[0] * bterm[1], g, Lambda)
-    k10 = cauchy(aterm[1] * bterm[0], g, Lambda)
-    k11 = cauchy(aterm[1] * bterm[1], g, Lambda)
+    k00 = _cauchy(aterm[0] * bterm[0], g, Lambda)
+    k01 = _cauchy(aterm[0] * bterm[1], g, Lambda)
+    k10 = _cauchy(aterm[1] * bterm[0], g, Lambda)
+    k11 = _cauchy(aterm[1] * bterm[1], g, Lambda)
     atRoots = c * (k00 - k01 * (1.0 / (1.0 + k11)) * k10)
-    out = jnp.fft.ifft(atRoots, L).reshape(L)
-    return out.real
+    if conj_sym:
+        out = jnp.fft.irfft(atRoots, L).reshape(L)
+    else:
+        out = jnp.fft.ifft(atRoots, L).reshape(L).real
+
+    if fft_len is not None:
+        # The truncation of the kernel at L is folded into C (C~ = C(I - A^L)), so at the odd
+        # frequencies of a finer grid the generating function is not the spectrum of the
+        # truncated kernel. The padded spectrum is therefore taken from the length L kernel.
+        return jnp.fft.rfft(out, n=fft_len)
+    return out
 
 
 def discrete_DPLR(
@@ -84,31 +323,218 @@ def discrete_DPLR(
     C: jnp.ndarray,
     step: float,
     L: int,
+    conj_sym: bool = False,
 ) -> jnp.ndarray:
-    # Convert parameters to matrices
-    B = B[:, jnp.newaxis]
-    Ct = C[jnp.newaxis, :]
+    if conj_sym:
+        # Discretize the full system, only the rows of the stored half of the state are kept
+        n = Lambda.shape[0]
+        Ab, Bb, Cb = discrete_DPLR(
+            *map(conj_pair, (Lambda, P, Q, B, C)), step=step, L=L
+        )
+        return Ab[:n], Bb[:n], Cb[:, :n]
+
+    # Forward Euler, A0 = 2 / step + Lambda - P Q*
+    Qc = Q.conj()
+    A0_diag = (2.0 / step) + Lambda
+
+    # Backward Euler, A1 = D - r D P Q* D
+    D = 1.0 / ((2.0 / step) - Lambda)
+    r = 1.0 / (1.0 + Qc @ (D * P))
+
+    # A bar = A1 A0 and B bar = 2 A1 B, the rank one terms are expanded so that no N x N
+    # matrix product is needed
+    DP, QcD = D * P, Qc * D
+    Ab = (
+        jnp.diag(D * A0_diag)
+        - DP[:, jnp.newaxis] * Qc
+        - r * DP[:, jnp.newaxis] * (QcD * A0_diag)
+        + r * (QcD @ P) * DP[:, jnp.newaxis] * Qc
+    )
+    Bb = 2.0 * (D * B - r * (QcD @ B) * DP)
 
-    N = Lambda.shape[0]
-    A = jnp.diag(Lambda) - P[:, jnp.newaxis] @ Q[:, jnp.newaxis].conj().T
-    I = jnp.eye(N)
+    # Recover Cbar from Ct (Ct = \tilde C in the thesis)
+    Cb = discrete_DPLR_C(Lambda, P, Q, C, step, L)
+    return Ab, Bb[:, jnp.newaxis], Cb[jnp.newaxis, :]
 
-    # Forward Euler
-    A0 = (2.0 / step) * I + A
 
-    # Backward Euler
-    D = jnp.diag(1.0 / ((2.0 / step) - Lambda))
-    Qc = Q.conj().T.reshape(1, -1)
-    P2 = P.reshape(-1, 1)
-    A1 = D - (D @ P2 * (1.0 / (1 + (Qc @ D @ P2))) * Qc @ D)
+def discrete_DPLR_C(
+    Lambda: jnp.ndarray,
+    P: jnp.ndarray,
+    Q: jnp.ndarray,
+    C: jnp.ndarray,
+    step: float,
+    L: int,
+    conj_sym: bool = False,
+) -> jnp.ndarray:
+    """Cbar = Ct (I - Ab^L)^-1 in O(NL) instead of an N x N inverse and matrix power.
+
+    With the roots of unity w^L = 1, (I - Ab^L)^-1 = 1/L sum_w (I - w Ab)^-1 and
+    I - w Ab = A1 M(w) with M(w) = (1 - w) 2 / step - (1 + w) (Lambda - P Q*), so that
+    Cbar = 1/L (sum_w Ct M(w)^-1) (2 / step - Lambda + P Q*). Every M(w) is diagonal plus
+    rank one and is inverted with Woodbury. Ab has no eigenvalue on the unit circle for a
+    stable Lambda, which keeps all the M(w) invertible.
+    """
+    if conj_sym:
+        # Discretize the full system, only the stored half of the state is kept
+        n = Lambda.shape[0]
+        Cb = discrete_DPLR_C(*map(conj_pair, (Lambda, P, Q, C)), step=step, L=L)
+        return Cb[:n]
+
+    # The output row is C* as in kernel_DPLR, Ct below stands for it
+    Ct, Qc = C.conj(), Q.conj()
+    omega = jnp.exp((2j * jnp.pi / L) * jnp.arange(L))[:, jnp.newaxis]
+
+    # Diagonal part of M(w) for all roots at once: (L, N)
+    inv_d = 1.0 / ((1.0 - omega) * (2.0 / step) - (1.0 + omega) * Lambda)
+
+    # Woodbury, Ct M^-1 = Ct d^-1 - (1 + w) (Ct d^-1 P) / (1 + (1 + w) Q* d^-1 P) Q* d^-1
+    cdP = inv_d @ (Ct * P)
+    qdP = inv_d @ (Qc * P)
+    w = (1.0 + omega[:, 0]) * cdP / (1.0 + (1.0 + omega[:, 0]) * qdP)
+    CtM = (Ct * inv_d.sum(axis=0) - Qc * (w @ inv_d)) / L
+
+    # Multiply with A1^-1 = 2 / step - Lambda + P Q*
+    return CtM * ((2.0 / step) - Lambda) + (CtM @ P) * Qc
+
+
+def discrete_DPLR_factors(
+    Lambda: jnp.ndarray,
+    P: jnp.ndarray,
+    Q: jnp.ndarray,
+    B: jnp.ndarray,
+    C: jnp.ndarray,
+    step: float,
+    L: int,
+    conj_sym: bool = False,
+) -> Tuple[jnp.ndarray, ...]:
+    """Bilinear discretisation kept in DPLR form instead of the dense N x N Ab:
+    A0 = 2 / step + Lambda - P Q*, A1 = D - r D P Q* D with D = (2 / step - Lambda)^-1,
+    returns (A0 diagonal, D, P, Q, r, Bb, Cb), see step_DPLR
+    """
+    Cb = discrete_DPLR_C(Lambda, P, Q, C, step, L, conj_sym)
+    return discrete_DPLR_step(Lambda, P, Q, B, step, conj_sym) + (Cb,)
 
-    # A bar and B bar
-    Ab = A1 @ A0
-    Bb = 2 * A1 @ B
 
-    # Recover Cbar from Ct (Ct = \tilde C in the thesis)
-    Cb = Ct @ inv(I - matrix_power(Ab, L)).conj()
-    return Ab, Bb, Cb.conj()
+def discrete_DPLR_step(
+    Lambda: jnp.ndarray,
+    P: jnp.ndarray,
+    Q: jnp.ndarray,
+    B: jnp.ndarray,
+    step: float,
+    conj_sym: bool = False,
+) -> Tuple[jnp.ndarray, ...]:
+    """The factors of discrete_DPLR_factors that do not depend on C, in O(N):
+    (A0 diagonal, D, P, Q, r, Bb) with Bb = 2 A1 B
+    """
+    n = Lambda.shape[0]
+    D = 1.0 / ((2.0 / step) - Lambda)
+    _full = conj_pair if conj_sym else (lambda x: x)
+
+    # Kept with shape (1,) so that the factors can be mapped over channels by cloneLayer
+    r = 1.0 / (1.0 + (_full(Q).conj() * _full(D) * _full(P)).sum(keepdims=True))
+
+    DB = _full(D * B)
+    Bb = 2.0 * (DB - r * (_full(Q).conj() @ DB) * _full(D * P))
+    return (2.0 / step) + Lambda, D, P, Q, r, Bb[:n]
+
+
+@partial(jax.checkpoint, static_argnums=(2, 3))
+def propagate_DPLR(
+    ssm: Tuple[jnp.ndarray, ...], x: jnp.ndarray, L: int, conj_sym: bool = False
+) -> jnp.ndarray:
+    """Ab^L x from L steps of step_DPLR without input, O(NL) instead of the N x N matrix
+    power. Propagates the state over a chunk of L steps of a sequence split over devices,
+    the steps are recomputed in the backward pass.
+    """
+    return jax.lax.fori_loop(0, L, lambda _, x: step_DPLR(ssm, x, 0.0, conj_sym), x)
+
+
+def kernel_S4D(
+    Lambda: jnp.ndarray,
+    B: jnp.ndarray,
+    C: jnp.ndarray,
+    step: float,
+    L: int,
+    fft_len: Optional[int] = None,
+) -> jnp.ndarray:
+    """Convolution kernel of length L of a diagonal (conjugate symmetric) SSM discretised
+    with zero order hold, or with fft_len set, the rfft of the kernel zero padded to fft_len
+    """
+    Lambda_bar = jnp.exp(Lambda * step)
+    W = C * B * (Lambda_bar - 1.0) / Lambda
+
+    if fft_len is None:
+        # Vandermonde product, K_t = 2 Re(sum_n W_n Lambda_bar_n^t)
+        V = Lambda_bar[:, jnp.newaxis] ** jnp.arange(L)
+        return 2 * (W @ V).real
+
+    # Geometric sums of the truncated kernel at the roots of unity of the padded length
+    z = jnp.exp((-2j * jnp.pi) * (jnp.arange(fft_len // 2 + 1) / fft_len))
+    geometric = lambda a: (1.0 - a**L) / (1.0 - a)
+    return W @ geometric(Lambda_bar[:, jnp.newaxis] * z) + W.conj() @ geometric(
+        Lambda_bar.conj()[:, jnp.newaxis] * z
+    )
+
+
+def discrete_S4D(
+    Lambda: jnp.ndarray, B: jnp.ndarray, C: jnp.ndarray, step: float
+) -> Tuple[jnp.ndarray, ...]:
+    """Zero order hold discretisation of a diagonal SSM"""
+    Lambda_bar = jnp.exp(Lambda * step)
+    return Lambda_bar, B * (Lambda_bar - 1.0) / Lambda, C
+
+
+def scan_SSM_diag(
+    ssm: Tuple[jnp.ndarray, ...], u: jnp.ndarray, x0: jnp.ndarray
+) -> jnp.ndarray:
+    """scan_SSM with an elementwise state update: (l), (n) -> (n), (l)"""
+    Lambda_bar, B_bar, C = ssm
+
+    def step(x_k_1, u_k):
+        x_k = Lambda_bar * x_k_1 + B_bar * u_k
+        y_k = 2 * C @ x_k
+        return x_k, y_k
+
+    return jax.lax.scan(step, x0, u)
+
+
+def prefill_S4D(
+    ssm: Tuple[jnp.ndarray, ...], u: jnp.ndarray, x0: jnp.ndarray
+) -> Tuple[jnp.ndarray, ...]:
+    """Response of the output to the initial state and final state of scan_SSM_diag,
+    computed with Vandermonde products instead of stepping: (l), (n) -> (n), (l)
+    """
+    Lambda_bar, B_bar, C = ssm
+    L = u.shape[0]
+    V = Lambda_bar[:, jnp.newaxis] ** jnp.arange(L + 1)
+
+    y_x0 = 2 * ((C * x0) @ V[:, 1:]).real
+    x_L = V[:, L] * x0 + (B_bar[:, jnp.newaxis] * V[:, L - 1 :: -1]) @ u
+    return x_L, y_x0
+
+
+def discrete_S5(
+    Lambda: jnp.ndarray, B: jnp.ndarray, step: jnp.ndarray
+) -> Tuple[jnp.ndarray, ...]:
+    """Zero order hold discretisation of a diagonal MIMO SSM: (n), (n, h), (n)"""
+    Lambda_bar = jnp.exp(Lambda * step)
+    return Lambda_bar, ((Lambda_bar - 1.0) / Lambda)[:, jnp.newaxis] * B
+
+
+def scan_SSM_assoc(
+    Lambda_bar: jnp.ndarray, Bu: jnp.ndarray, x0: jnp.ndarray
+) -> jnp.ndarray:
+    """Parallel scan of x_k = Lambda_bar * x_k-1 + Bu_k: (n), (l, n), (n) -> (l, n)"""
+
+    def binary_op(e_i, e_j):
+        a_i, b_i = e_i
+        a_j, b_j = e_j
+        return a_j * a_i, a_j * b_i + b_j
+
+    Bu = Bu.at[0].add(Lambda_bar * x0)
+    A = jnp.broadcast_to(Lambda_bar, Bu.shape)
+    _, xs = jax.lax.associative_scan(binary_op, (A, Bu))
+    return xs
 
 
 def make_NPLR_HiPPO(N: int) -> jnp.ndarray:
@@ -141,6 +567,35 @@ def make_DPLR_HiPPO(N: int) -> jnp.ndarray:
     return Lambda_real + 1j * Lambda_imag, P, B, V
 
 
+@lru_cache(maxsize=None)
+def cached_DPLR_HiPPO(
+    N: int, cache_dir: Optional[str] = None
+) -> Tuple[np.ndarray, ...]:
+    """make_DPLR_HiPPO computed once per N and process, and with cache_dir set, once per N
+    on disk. Evaluated eagerly even when called while tracing, the result is kept as
+    read-only numpy arrays.
+    """
+    path = cache_dir and os.path.join(cache_dir, f"dplr_hippo_{N}.npz")
+    if path and os.path.exists(path):
+        with np.load(path) as f:
+            out = tuple(f[k] for k in ("Lambda", "P", "B", "V"))
+    else:
+        with jax.ensure_compile_time_eval():
+            out = tuple(np.asarray(x) for x in make_DPLR_HiPPO(N))
+
+        if path:
+            # Write to a temporary file first, so that concurrent runs never read a partial file
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **dict(zip(("Lambda", "P", "B", "V"), out)))
+            os.replace(tmp_path, path)
+
+    for x in out:
+        x.setflags(write=False)
+    return out
+
+
 def init(x):
     def _init(key, shape):
         assert shape == x.shape
@@ -149,6 +604,13 @@ def init(x):
     return _init
 
 
-def hippo_initializer(N: int) -> jnp.ndarray:
-    Lambda, P, B, _ = make_DPLR_HiPPO(N)
+def hippo_initializer(
+    N: int, conj_sym: bool = False, cache_dir: Optional[str] = None
+) -> jnp.ndarray:
+    Lambda, P, B = map(jnp.asarray, cached_DPLR_HiPPO(N, cache_dir)[:3])
+    if conj_sym:
+        # The eigenvalues come in conjugate pairs and eigh sorts them by their imaginary part,
+        # so the second half holds one eigenvalue of every pair
+        assert N % 2 == 0, "conj_sym requires an even state size"
+        Lambda, P, B = Lambda[N // 2 :], P[N // 2 :], B[N // 2 :]
     return init(Lambda.real), init(Lambda.imag), init(P), init(B)
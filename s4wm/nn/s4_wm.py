@@ -6,18 +6,32 @@ import torch
 
 from functools import partial
 from flax import linen as nn
-from tensorflow_probability.substrates import jax as tfp
 from omegaconf import DictConfig
 
 from .decoder import ResNetDecoder
 from .encoder import ResNetEncoder
-from .s4_nn import S4Blocks
-from .dists import OneHotDist, MSEDist, sg, LogCoshDist
+from .s4_nn import (
+    S4Blocks,
+    S4Blocks_to_scanned,
+    reset_RNN_cache,
+    RematPolicy,
+    remat,
+    get_precision,
+    cast_params,
+)
+from .dists import (
+    OneHotDist,
+    DiagGaussianDist,
+    LatentDist,
+    ImageDist,
+    MSEDist,
+    LogCoshDist,
+    scale_grad,
+)
 
 from s4wm.utils.dlpack import from_jax_to_torch, from_torch_to_jax
-from typing import Dict, Union, Tuple, Sequence, Literal, Any
+from typing import Dict, Union, Tuple, Sequence, Literal, Any, Optional
 
-tfd = tfp.distributions
 f32 = jnp.float32
 
 ImageDistribution = Literal["MSE", "LogCosh"]
@@ -30,6 +44,11 @@ PyTree = Union[Any, tuple, list, dict, PyTreeDef]
 PRNGKey = jnp.ndarray
 
 
+def take_timesteps(x: jnp.ndarray, idx: jnp.ndarray) -> jnp.ndarray:
+    """Gather the timesteps idx (batch, k) of x (batch, seq_l, ...)"""
+    return jnp.take_along_axis(x, idx.reshape(idx.shape + (1,) * (x.ndim - 2)), axis=1)
+
+
 class S4WM(nn.Module):
     S4_config: DictConfig
 
@@ -51,48 +70,93 @@ class S4WM(nn.Module):
     image_dist_type: ImageDistribution = "MSE"
     latent_dist_type: LatentDistribution = "Categorical"
     loss_reduction: LossReduction = "mean"
+    # Decode and score only this many random timesteps per sequence during training, the KL
+    # still covers every step, see sample_recon_timesteps
+    recon_timesteps: Optional[int] = None
+
+    # Activations recomputed in the backward pass during training, see s4_nn.remat
+    remat: RematPolicy = "none"
+
+    # Param, compute and output dtypes of the encoder, decoder, heads and S4 blocks, see
+    # s4_nn.get_precision. None runs everything in float32.
+    precision: Optional[Dict] = None
 
     def setup(self) -> None:
         self.rng_post, self.rng_prior = jax.random.split(jax.random.PRNGKey(0), num=2)
         self.discrete_latent_state = self.latent_dist_type == "Categorical"
 
-        self.encoder = ResNetEncoder(act_fn=nn.silu)
-        self.decoder = ResNetDecoder(act_fn=nn.silu)
+        self.encoder_precision = get_precision(self.precision, "encoder")
+        self.decoder_precision = get_precision(self.precision, "decoder")
+        self.heads_precision = get_precision(self.precision, "heads")
+        self.S4_precision = get_precision(self.precision, "s4_blocks")
+
+        policy = self.remat if self.training else "none"
+        self.encoder = remat(ResNetEncoder, policy, "encoder_decoder")(
+            act_fn=nn.silu,
+            dtype=self.encoder_precision.dtype,
+            param_dtype=self.encoder_precision.param_dtype,
+        )
+        self.decoder = remat(ResNetDecoder, policy, "encoder_decoder")(
+            act_fn=nn.silu,
+            dtype=self.decoder_precision.dtype,
+            param_dtype=self.decoder_precision.param_dtype,
+        )
 
         self.S4_blocks = S4Blocks(
-            **self.S4_config, rnn_mode=self.rnn_mode, training=self.training
+            **self.S4_config,
+            rnn_mode=self.rnn_mode,
+            training=self.training,
+            remat=self.remat,
+            dtype=self.S4_precision.dtype,
+            param_dtype=self.S4_precision.param_dtype,
         )
 
+        dense = partial(
+            nn.Dense,
+            dtype=self.heads_precision.dtype,
+            param_dtype=self.heads_precision.param_dtype,
+        )
         self.statistic_heads = {
             "embedding": nn.Sequential(
                 [
-                    nn.Dense(features=self.latent_dim),
+                    dense(features=self.latent_dim),
                     nn.silu,
-                    nn.Dense(features=self.latent_dim),
+                    dense(features=self.latent_dim),
                 ]
             ),
             "hidden": nn.Sequential(
                 [
-                    nn.Dense(features=self.S4_config["d_model"]),
+                    dense(features=self.S4_config["d_model"]),
                     nn.silu,
-                    nn.Dense(features=self.S4_config["d_model"]),  # 1x 2024
+                    dense(features=self.S4_config["d_model"]),  # 1x 2024
                     nn.silu,
-                    nn.Dense(features=self.latent_dim),
+                    dense(features=self.latent_dim),
                 ]
             ),
         }
 
         self.input_head = nn.Sequential(
             [
-                nn.Dense(features=self.S4_config["d_model"]),
+                dense(features=self.S4_config["d_model"]),
                 nn.silu,
-                nn.Dense(features=self.S4_config["d_model"]),
+                dense(features=self.S4_config["d_model"]),
             ]
         )
 
+    def encode(self, depth_imgs: jnp.ndarray) -> jnp.ndarray:
+        embeddings = self.encoder(depth_imgs)
+        return embeddings.astype(self.encoder_precision.output_dtype)
+
+    def decode(self, x: jnp.ndarray) -> jnp.ndarray:
+        return self.decoder(x).astype(self.decoder_precision.output_dtype)
+
+    def step_S4_blocks(self, g: jnp.ndarray) -> jnp.ndarray:
+        g = self.input_head(g).astype(self.heads_precision.output_dtype)
+        return self.S4_blocks(g).astype(self.S4_precision.output_dtype)
+
     def compute_latent(
         self, statistics: jnp.ndarray, rng_seed: PRNGKey
-    ) -> Tuple[jnp.ndarray, tfd.Distribution]:
+    ) -> Tuple[jnp.ndarray, LatentDist]:
         dists = self.get_latent_distribution(statistics)
 
         if not self.sample_mean:
@@ -111,43 +175,74 @@ class S4WM(nn.Module):
 
     def compute_posteriors(
         self, embedding: jnp.ndarray, rng_seed: PRNGKey
-    ) -> Tuple[jnp.ndarray, tfd.Distribution]:
+    ) -> Tuple[jnp.ndarray, LatentDist]:
         post_stats = self.get_statistics(embedding, statistics_head="embedding")
         return self.compute_latent(post_stats, rng_seed)
 
     def compute_priors(
         self, hidden: jnp.ndarray, rng_seed: PRNGKey
-    ) -> Tuple[jnp.ndarray, tfd.Distribution]:
+    ) -> Tuple[jnp.ndarray, LatentDist]:
         prior_stats = self.get_statistics(hidden, statistics_head="hidden")
         return self.compute_latent(prior_stats, rng_seed)
 
     def reconstruct_depth(
         self, hidden: jnp.ndarray, latent_sample: jnp.ndarray
-    ) -> tfd.Distribution:
-        x = self.decoder(jnp.concatenate((hidden, latent_sample), axis=-1))
+    ) -> ImageDist:
+        x = self.decode(jnp.concatenate((hidden, latent_sample), axis=-1))
         return self.get_image_distribution(x)
 
+    def reconstruct_depths(
+        self, hidden: jnp.ndarray, latent_samples: Sequence[jnp.ndarray]
+    ) -> Tuple[ImageDist, ...]:
+        """Reconstructions of every latent sample with the same hidden states, from a single
+        decoder call over the samples concatenated along the batch
+        """
+        x = jnp.concatenate(
+            [jnp.concatenate((hidden, z), axis=-1) for z in latent_samples], axis=0
+        )
+        x = self.decode(x)
+        return tuple(
+            self.get_image_distribution(x)
+            for x in jnp.split(x, len(latent_samples), axis=0)
+        )
+
     def compute_loss(
         self,
-        img_prior_dist: tfd.Distribution,
+        img_prior_dist: ImageDist,
         img_posterior: jnp.ndarray,
-        z_posterior_dist: tfd.Distribution,
-        z_prior_dist: tfd.Distribution,
+        z_posterior_dist: LatentDist,
+        z_prior_dist: LatentDist,
+        mask: Optional[jnp.ndarray] = None,  # (batch, seq_l), zero for padded steps
+        recon_idx: Optional[jnp.ndarray] = None,  # (batch, k), the decoded timesteps
     ) -> jnp.ndarray:
-        dynamics_loss = sg(z_posterior_dist).kl_divergence(z_prior_dist)
-        representation_loss = z_posterior_dist.kl_divergence(sg(z_prior_dist))
+        # The dynamics and representation losses are the same KL with the gradient to the
+        # prior and the posterior respectively, evaluated once with the balance applied to
+        # the gradients of the distributions
+        kl_loss = scale_grad(z_posterior_dist, 1 - self.alpha).kl_divergence(
+            scale_grad(z_prior_dist, self.alpha)
+        )
 
         if self.clip_kl_loss:
-            dynamics_loss = jnp.maximum(dynamics_loss, self.kl_lower_bound)
-            representation_loss = jnp.maximum(representation_loss, self.kl_lower_bound)
+            kl_loss = jnp.maximum(kl_loss, self.kl_lower_bound)
 
-        kl_loss = self.beta_kl * jnp.sum(
-            (self.alpha * dynamics_loss + (1 - self.alpha) * representation_loss),
-            axis=-1,
-        )
-        recon_loss = self.beta_rec * (
-            -jnp.sum(img_prior_dist.log_prob(img_posterior.astype(f32)), axis=-1)
-        )
+        recon_mask, recon_scale = mask, 1.0
+        if recon_idx is not None:
+            # The sum over the valid steps is estimated from the sampled ones, which are
+            # drawn uniformly from the valid steps first
+            valid = jnp.ones(kl_loss.shape) if mask is None else mask
+            img_posterior = take_timesteps(img_posterior, recon_idx)
+            recon_mask = take_timesteps(valid, recon_idx)
+            recon_scale = valid.sum(-1) / jnp.maximum(recon_mask.sum(-1), 1)
+
+        recon_loss = -img_prior_dist.log_prob(img_posterior.astype(f32))
+
+        if mask is not None:
+            kl_loss = kl_loss * mask
+        if recon_mask is not None:
+            recon_loss = recon_loss * recon_mask
+
+        kl_loss = self.beta_kl * jnp.sum(kl_loss, axis=-1)
+        recon_loss = self.beta_rec * recon_scale * jnp.sum(recon_loss, axis=-1)
 
         if self.loss_reduction == "mean":
             kl_loss = kl_loss / self.num_classes
@@ -159,19 +254,31 @@ class S4WM(nn.Module):
             kl_loss,
         )
 
+    def sample_recon_timesteps(
+        self, key: PRNGKey, mask: jnp.ndarray
+    ) -> Optional[jnp.ndarray]:
+        """Indices (batch, recon_timesteps) of distinct random timesteps of every sequence to
+        reconstruct, the valid steps of the mask are drawn first. None decodes every step.
+        """
+        if self.recon_timesteps is None or self.recon_timesteps >= mask.shape[-1]:
+            return None
+        # Valid steps score in [1, 2) and padded steps in [0, 1)
+        scores = jax.random.uniform(key, mask.shape) + (mask > 0)
+        return jax.lax.top_k(scores, self.recon_timesteps)[1]
+
     def get_latent_distribution(
         self, statistics: Union[Dict[str, jnp.ndarray], jnp.ndarray]
-    ) -> tfd.Distribution:
+    ) -> LatentDist:
         if self.latent_dist_type == "Categorical":
-            return tfd.Independent(OneHotDist(statistics["logits"].astype(f32)), 1)
+            return OneHotDist(statistics["logits"].astype(f32))
         elif self.latent_dist_type == "Gaussian":
-            mean = statistics["mean"]
-            std = statistics["std"]
-            return tfd.MultivariateNormalDiag(mean, std)
+            mean = statistics["mean"].astype(f32)
+            std = statistics["std"].astype(f32)
+            return DiagGaussianDist(mean, std)
         else:
             raise NotImplementedError("Latent distribution type not defined")
 
-    def get_image_distribution(self, statistics: jnp.ndarray) -> tfd.Distribution:
+    def get_image_distribution(self, statistics: jnp.ndarray) -> ImageDist:
         mode = statistics.reshape(statistics.shape[0], statistics.shape[1], -1).astype(
             f32
         )
@@ -189,7 +296,7 @@ class S4WM(nn.Module):
         unimix: float = 0.01,
     ) -> Dict[str, jnp.ndarray]:
         if self.discrete_latent_state:
-            logits = self.statistic_heads[statistics_head](x)
+            logits = self.statistic_heads[statistics_head](x).astype(f32)
             logits = logits.reshape(
                 logits.shape[0], logits.shape[1], self.num_modes, self.num_classes
             )
@@ -200,7 +307,7 @@ class S4WM(nn.Module):
                 logits = jnp.log(probs)
             return {"logits": logits}
         else:
-            x = self.statistic_heads[statistics_head](x)
+            x = self.statistic_heads[statistics_head](x).astype(f32)
             mean, std = jnp.split(x, 2, -1)
             std = nn.softplus(std) + 0.1
 
@@ -212,7 +319,8 @@ class S4WM(nn.Module):
         actions: jnp.ndarray,
         rng_seed: PRNGKey,
         reconstruct_priors: bool = False,
-    ) -> Dict[str, Tuple[tfd.Distribution, jnp.ndarray]]:
+        recon_idx: Optional[jnp.ndarray] = None,  # (batch, k), timesteps to decode
+    ) -> Dict[str, Tuple[Union[LatentDist, ImageDist], jnp.ndarray]]:
         out = {
             "z_post": {"dist": None, "sample": None},
             "z_prior": {"dist": None, "sample": None},
@@ -223,12 +331,12 @@ class S4WM(nn.Module):
         post_key, prior_key = jax.random.split(rng_seed)
         multi_step = depth_imgs.shape[1] > 1
 
-        embeddings = self.encoder(depth_imgs)
+        embeddings = self.encode(depth_imgs)
         out["z_post"]["sample"], out["z_post"]["dist"] = self.compute_posteriors(
             embeddings, post_key
         )
 
-        g = self.input_head(
+        out["hidden"] = self.step_S4_blocks(
             jnp.concatenate(
                 (
                     (
@@ -241,33 +349,46 @@ class S4WM(nn.Module):
                 axis=-1,
             )
         )
-        out["hidden"] = self.S4_blocks(g)
 
         out["z_prior"]["sample"], out["z_prior"]["dist"] = self.compute_priors(
             out["hidden"], prior_key
         )
 
-        out["depth"]["recon"] = self.reconstruct_depth(
-            out["hidden"],
-            (out["z_post"]["sample"][:, 1:] if multi_step else out["z_post"]["sample"]),
+        hidden, z_prior = out["hidden"], out["z_prior"]["sample"]
+        z_post = (
+            out["z_post"]["sample"][:, 1:] if multi_step else out["z_post"]["sample"]
         )
+        if recon_idx is not None:
+            hidden, z_post, z_prior = (
+                take_timesteps(x, recon_idx) for x in (hidden, z_post, z_prior)
+            )
 
         if reconstruct_priors:
-            out["depth"]["pred"] = self.reconstruct_depth(
-                out["hidden"], out["z_prior"]["sample"]
+            out["depth"]["recon"], out["depth"]["pred"] = self.reconstruct_depths(
+                hidden, (z_post, z_prior)
             )
+        else:
+            out["depth"]["recon"] = self.reconstruct_depth(hidden, z_post)
 
         return out
 
     def forward_open_loop(
-        self, predicted_posterior: jnp.ndarray, action: jnp.ndarray, key
+        self,
+        predicted_posterior: jnp.ndarray,
+        action: jnp.ndarray,
+        key,
+        decode: bool = True,
     ) -> Tuple[jnp.ndarray, ...]:  # 2 tuple
+        """One open loop step. Without decode depth_pred is None and only the S4 blocks and the
+        prior head run, the images can be decoded afterwards from hidden and the samples of
+        any number of steps at once with reconstruct_depth.
+        """
         out = {
             "z_post_pred": {"dist": None, "sample": None},
             "depth_pred": None,
             "hidden": None,
         }
-        g = self.input_head(
+        out["hidden"] = self.step_S4_blocks(
             jnp.concatenate(
                 (
                     predicted_posterior,
@@ -276,26 +397,26 @@ class S4WM(nn.Module):
                 axis=-1,
             )
         )
-        out["hidden"] = self.S4_blocks(g)
         out["z_post_pred"]["sample"], out["z_post_pred"]["dist"] = self.compute_priors(
             out["hidden"], rng_seed=key
         )
-        out["depth_pred"] = self.reconstruct_depth(
-            out["hidden"], out["z_post_pred"]["sample"]
-        )
+        if decode:
+            out["depth_pred"] = self.reconstruct_depth(
+                out["hidden"], out["z_post_pred"]["sample"]
+            )
         return out
 
     def encode_and_step(
         self, image: jnp.ndarray, action: jnp.ndarray, latent: jnp.ndarray, key
     ) -> Tuple[jnp.ndarray, ...]:  # 2 Tuple
-        z, _ = self.compute_posteriors(self.encoder(image), key)
-        h = self.S4_blocks(self.input_head(jnp.concatenate((latent, action), axis=-1)))
+        z, _ = self.compute_posteriors(self.encode(image), key)
+        h = self.step_S4_blocks(jnp.concatenate((latent, action), axis=-1))
         return z, h
 
     def encode_and_step_open_loop(
         self, action: jnp.ndarray, latent: jnp.ndarray, key
     ) -> Tuple[jnp.ndarray, ...]:  # 2 tuple
-        h = self.S4_blocks(self.input_head(jnp.concatenate((latent, action), axis=-1)))
+        h = self.step_S4_blocks(jnp.concatenate((latent, action), axis=-1))
         z, _ = self.compute_priors(h, key)
         return z, h
 
@@ -323,6 +444,50 @@ class S4WM(nn.Module):
 
         return vars["cache"], prime_vars["prime"]
 
+    def prefill_RNN_mode(
+        self,
+        params: PyTree,
+        cache: PyTree,
+        imgs: jnp.ndarray,
+        actions: jnp.ndarray,
+        rng_seed: PRNGKey,
+    ) -> Tuple[Dict, PyTree]:  # 2 tuple
+        """Ingest a context of frames in one CNN mode call instead of stepping through it in
+        RNN mode. The S4 layers start from the states in cache and the returned cache holds
+        their states after the last step, ready to continue stepping in RNN mode.
+        """
+        assert self.rnn_mode
+
+        out, vars = self.clone(rnn_mode=False).apply(
+            {"params": params, "cache": cache},
+            imgs,
+            actions,
+            rng_seed,
+            True,
+            mutable=["cache"],
+        )
+
+        return out, vars["cache"]
+
+    def init_CNN_mode(
+        self, params: PyTree, init_imgs: jnp.ndarray, init_actions: jnp.ndarray
+    ) -> PyTree:
+        """Precompute the convolution kernels of every S4 layer for frozen parameters. Passing
+        the returned "prime" collection to apply skips the kernel generation on every call.
+        Layers without a convolution kernel (S5) store nothing, so the tree may be empty.
+        """
+        assert not self.rnn_mode
+
+        _, prime_vars = self.apply(
+            {"params": params},
+            init_imgs,
+            init_actions,
+            jax.random.PRNGKey(2),
+            mutable=["prime"],
+        )
+
+        return prime_vars.get("prime", {})
+
     def restore_checkpoint_state(self, ckpt_dir: str) -> PyTree:
         ckptr = orbax.checkpoint.Checkpointer(
             orbax.checkpoint.PyTreeCheckpointHandler()
@@ -332,6 +497,52 @@ class S4WM(nn.Module):
         return ckpt_state
 
 
+def cast_S4WM_params(params: PyTree, precision: Optional[Dict]) -> PyTree:
+    """Cast the parameters of every submodule of S4WM to the param_dtype of its precision, e.g.
+    to halve the weight bandwidth when stepping a float32 checkpoint in bfloat16. The SSM
+    parameters stay in float32.
+    """
+    submodules = {"encoder": "encoder", "decoder": "decoder", "S4_blocks": "s4_blocks"}
+    return {
+        k: cast_params(
+            v, get_precision(precision, submodules.get(k, "heads")).param_dtype
+        )
+        for k, v in params.items()
+    }
+
+
+class KernelCache:
+    """Kernels of a CNN mode S4WM (see S4WM.init_CNN_mode), recomputed only when the
+    parameters are swapped. A parameter set is fingerprinted by the identity of its leaves,
+    the cache keeps a reference to them so that the identities cannot be reused.
+    """
+
+    def __init__(self, model: S4WM) -> None:
+        self.model = model
+        self._params = None
+        self._prime = None
+
+    def _is_cached(self, params: PyTree) -> bool:
+        if self._params is None:
+            return False
+        leaves, treedef = jax.tree_util.tree_flatten(params)
+        cached_leaves, cached_treedef = jax.tree_util.tree_flatten(self._params)
+        return treedef == cached_treedef and all(
+            leaf is cached for leaf, cached in zip(leaves, cached_leaves)
+        )
+
+    def __call__(
+        self, params: PyTree, init_imgs: jnp.ndarray, init_actions: jnp.ndarray
+    ) -> PyTree:
+        # The kernel tree of a model without convolution kernels is empty for any parameters
+        if self._prime is not None and not jax.tree_util.tree_leaves(self._prime):
+            return self._prime
+        if not self._is_cached(params):
+            self._prime = self.model.init_CNN_mode(params, init_imgs, init_actions)
+            self._params = params
+        return self._prime
+
+
 # ---- Torch utilities and wrappers ----
 
 
@@ -381,6 +592,18 @@ def _jitted_open_loop_predict(
     )
 
 
+@partial(jax.jit, static_argnums=(0))
+def _jitted_decode(
+    model: S4WM,
+    params: PyTree,
+    hidden: jnp.ndarray,
+    latent: jnp.ndarray,
+) -> jax.Array:
+    return model.apply(
+        {"params": params}, hidden, latent, method="reconstruct_depth"
+    ).mean()
+
+
 class S4WMTorchWrapper:
     def __init__(
         self,
@@ -392,6 +615,13 @@ class S4WMTorchWrapper:
         num_S4_blocks: int = 4,
         l_max: int = 99,
         sample_mean: bool = True,
+        layer_config: Optional[Dict] = None,  # Extra S4 layer arguments
+        scan_blocks: bool = False,
+        # Blocks on the sequence down pooled by pool_factor, see s4_nn.PooledS4Blocks
+        pooled_blocks: int = 0,
+        pool_factor: int = 1,
+        # Per submodule dtypes, see s4_nn.get_precision
+        precision: Optional[Dict] = None,
     ) -> None:
         self.d_pssm_block = S4_block_dim
         self.d_ssm = ssm_dim
@@ -401,14 +631,18 @@ class S4WMTorchWrapper:
             S4_config=DictConfig(
                 {
                     "d_model": S4_block_dim,
-                    "layer": {"l_max": l_max, "N": ssm_dim},
+                    "layer": {"l_max": l_max, "N": ssm_dim, **(layer_config or {})},
                     "n_blocks": num_S4_blocks,
+                    "scan_blocks": scan_blocks,
+                    "pooled_blocks": pooled_blocks,
+                    "pool_factor": pool_factor,
                 }
             ),
             training=False,
             rnn_mode=True,
             sample_mean=sample_mean,
             latent_dist_type="Gaussian",
+            precision=DictConfig(precision) if precision is not None else None,
             **DictConfig(
                 {
                     "latent_dim": latent_dim,
@@ -417,6 +651,10 @@ class S4WMTorchWrapper:
         )
 
         self.params = self.model.restore_checkpoint_state(ckpt_path)["params"]
+        if scan_blocks and "blocks_0" in self.params["S4_blocks"]:
+            # Checkpoint of a model with unrolled blocks
+            self.params = S4Blocks_to_scanned(self.params)
+        self.params = cast_S4WM_params(self.params, self.model.precision)
 
         init_depth = jnp.zeros((batch_dim, 1, 135, 240, 1))
         init_actions = jnp.zeros((batch_dim, 1, 4))
@@ -443,7 +681,7 @@ class S4WMTorchWrapper:
             self.key,
         )
 
-        _ = _jitted_open_loop_predict(
+        (init_latent, init_hidden), _ = _jitted_open_loop_predict(
             self.model,
             self.params,
             self.rnn_cache,
@@ -453,6 +691,8 @@ class S4WMTorchWrapper:
             self.key,
         )
 
+        _ = _jitted_decode(self.model, self.params, init_hidden, init_latent)
+
         return
 
     def forward(
@@ -513,19 +753,15 @@ class S4WMTorchWrapper:
             from_jax_to_torch(out[1]),
         )
 
+    def decode(self, hidden: torch.tensor, latents: torch.tensor) -> torch.tensor:
+        """Depth images of the (latent, hidden) pairs returned by open_loop_predict, e.g. every
+        k steps or a whole rollout stacked along the sequence at once
+        """
+        jax_hidden, jax_latent = from_torch_to_jax(hidden), from_torch_to_jax(latents)
+        depth = _jitted_decode(self.model, self.params, jax_hidden, jax_latent)
+        return from_jax_to_torch(depth)
+
     def reset_cache(self, batch_idx: Sequence) -> None:
         batch_idx = from_torch_to_jax(batch_idx)
-        for i in range(self.num_pssm_blocks):
-            for j in range(2):
-                self.rnn_cache["S4_blocks"][f"blocks_{i}"][f"layers_{j}"]["seq"][
-                    "cache_x_k"
-                ] = (
-                    self.rnn_cache["S4_blocks"][f"blocks_{i}"][f"layers_{j}"]["seq"][
-                        "cache_x_k"
-                    ]
-                    .at[jnp.array([batch_idx])]
-                    .set(
-                        jnp.zeros((self.d_ssm, self.d_pssm_block), dtype=jnp.complex64)
-                    )
-                )
+        self.rnn_cache = reset_RNN_cache(self.rnn_cache, jnp.array([batch_idx]))
         return
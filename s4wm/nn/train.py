@@ -6,14 +6,15 @@ import optax
 import torch
 
 from functools import partial
+from flax import struct
 from flax.training import checkpoints, train_state
 from torch.utils.data import DataLoader
 from omegaconf import DictConfig, OmegaConf
 from tqdm import tqdm
-from typing import Any, Union, Dict, Tuple
+from typing import Any, Union, Dict, Tuple, Optional, Sequence
 
-from s4wm.nn.s4_wm import S4WM
-from s4wm.nn.s4_nn import S4Layer
+from s4wm.nn.s4_wm import S4WM, KernelCache
+from s4wm.nn.s4_nn import SSM_LAYERS
 from s4wm.data.dataloaders import Dataloaders
 from s4wm.utils.dlpack import from_torch_to_jax
 
@@ -31,8 +32,48 @@ except (ImportError, AssertionError):
     wandb = None
 
 
+class DynamicLossScale(struct.PyTreeNode):
+    """Loss scale for float16 computations, whose small gradients underflow without it. The
+    scale is divided by factor when the gradients overflow, in which case the update is
+    skipped, and multiplied by factor after period steps with finite gradients.
+    """
+
+    scale: jnp.ndarray
+    counter: jnp.ndarray
+    period: int = struct.field(pytree_node=False, default=2000)
+    factor: float = struct.field(pytree_node=False, default=2.0)
+
+    @classmethod
+    def create(cls, scale: float, **kwargs) -> "DynamicLossScale":
+        return cls(
+            scale=jnp.asarray(scale, jnp.float32),
+            counter=jnp.zeros((), jnp.int32),
+            **kwargs,
+        )
+
+    def unscale(self, grads: PyTree) -> PyTree:
+        return jax.tree_util.tree_map(lambda g: g / self.scale, grads)
+
+    def adjust(self, grads_finite: jnp.ndarray) -> "DynamicLossScale":
+        counter = jnp.where(grads_finite, self.counter + 1, 0)
+        grow = counter == self.period
+        scale = jnp.where(
+            grads_finite,
+            jnp.where(grow, self.scale * self.factor, self.scale),
+            jnp.maximum(self.scale / self.factor, 1.0),
+        )
+        return self.replace(scale=scale, counter=jnp.where(grow, 0, counter))
+
+
+def all_finite(tree: PyTree) -> jnp.ndarray:
+    return jnp.all(
+        jnp.array([jnp.all(jnp.isfinite(x)) for x in jax.tree_util.tree_leaves(tree)])
+    )
+
+
 class TrainState(train_state.TrainState):
     batch_stats: Any
+    loss_scale: Optional[DynamicLossScale] = None
 
 
 def map_nested_fn(fn):
@@ -57,6 +98,7 @@ def create_train_state(
     use_batchmean: bool = False,
     weight_decay: float = 0.0,
     total_steps: int = -1,
+    loss_scale: Optional[float] = None,  # Initial dynamic loss scale, None disables it
 ) -> PyTree:
     model = model_cls(training=True)
     init_rng, dropout_rng, sample_rng = jax.random.split(rng, num=3)
@@ -130,18 +172,70 @@ def create_train_state(
     print(f"[*] Trainable Parameters: {sum(jax.tree_leaves(param_sizes))}")
     print(f"[*] Total training steps: {total_steps}")
 
+    if loss_scale is not None:
+        loss_scale = DynamicLossScale.create(loss_scale)
+
     if use_batchmean:
         return TrainState.create(
-            apply_fn=model.apply, params=params, batch_stats=batch_stats, tx=tx
+            apply_fn=model.apply,
+            params=params,
+            batch_stats=batch_stats,
+            tx=tx,
+            loss_scale=loss_scale,
         )
     else:
         return TrainState.create(
-            apply_fn=model.apply, params=params, batch_stats=batch_stats, tx=tx
+            apply_fn=model.apply,
+            params=params,
+            batch_stats=batch_stats,
+            tx=tx,
+            loss_scale=loss_scale,
         )
 
 
+def bucket_length(seq_len: int, length_buckets: Optional[Sequence[int]]) -> int:
+    """Smallest length bucket that fits seq_len, or seq_len itself without buckets"""
+    if not length_buckets:
+        return seq_len
+
+    fitting = [length for length in sorted(length_buckets) if length >= seq_len]
+    assert (
+        len(fitting) > 0
+    ), f"Sequence length {seq_len} exceeds the largest length bucket {max(length_buckets)}"
+    return fitting[0]
+
+
+def pad_to_bucket(
+    batch_depth: jnp.ndarray,
+    batch_actions: jnp.ndarray,
+    batch_labels: jnp.ndarray,
+    length_buckets: Optional[Sequence[int]],
+) -> Tuple[jnp.ndarray, ...]:  # 4 tuple
+    """Right pad a batch to its length bucket, so that train_step and eval_step are compiled
+    once per bucket instead of once per sequence length. The S4 stack is causal, so padding
+    at the end does not change the outputs of the real steps, which are selected by the
+    returned loss mask.
+    """
+    seq_len = batch_actions.shape[1]
+    pad = bucket_length(seq_len, length_buckets) - seq_len
+
+    _pad_time = lambda x: jnp.pad(x, [(0, 0), (0, pad)] + [(0, 0)] * (x.ndim - 2))
+    mask = _pad_time(jnp.ones(batch_actions.shape[:2], dtype=jnp.float32))
+
+    return (
+        _pad_time(batch_depth),
+        _pad_time(batch_actions),
+        _pad_time(batch_labels),
+        mask,
+    )
+
+
 def train_epoch(
-    state: PyTree, rng: PRNGKey, model_cls: callable, trainloader: DataLoader
+    state: PyTree,
+    rng: PRNGKey,
+    model_cls: callable,
+    trainloader: DataLoader,
+    length_buckets: Optional[Sequence[int]] = None,
 ) -> Tuple[PyTree, jnp.ndarray]:
     model = model_cls(training=True)
     batch_losses = []
@@ -149,13 +243,21 @@ def train_epoch(
     for batch_depth, batch_actions, batch_labels in tqdm(trainloader):
         rng, drop_rng, sample_rng = jax.random.split(rng, num=3)
 
+        batch_depth, batch_actions, batch_labels, batch_mask = pad_to_bucket(
+            from_torch_to_jax(batch_depth),
+            from_torch_to_jax(batch_actions),
+            from_torch_to_jax(batch_labels),
+            length_buckets,
+        )
+
         state, batch_loss, recon_loss, kld_loss = train_step(
             state,
             drop_rng,
             sample_rng,
-            from_torch_to_jax(batch_depth),
-            from_torch_to_jax(batch_actions),
-            from_torch_to_jax(batch_labels),
+            batch_depth,
+            batch_actions,
+            batch_labels,
+            batch_mask,
             model,
         )
         batch_losses.append(batch_loss)
@@ -174,19 +276,34 @@ def train_epoch(
 
 
 def validate(
-    state: PyTree, rng: PRNGKey, model_cls: callable, testloader: DataLoader
+    state: PyTree,
+    rng: PRNGKey,
+    kernel_cache: KernelCache,
+    testloader: DataLoader,
+    length_buckets: Optional[Sequence[int]] = None,
 ) -> float:
     losses = []
-    model = model_cls(training=False)
+    model = kernel_cache.model
 
     for batch_depth, batch_actions, batch_labels in tqdm(testloader):
+        batch_depth, batch_actions, batch_labels, batch_mask = pad_to_bucket(
+            from_torch_to_jax(batch_depth),
+            from_torch_to_jax(batch_actions),
+            from_torch_to_jax(batch_labels),
+            length_buckets,
+        )
+
+        # The parameters are frozen during validation, the S4 kernels are computed once
+        prime = kernel_cache(state.params, batch_depth[:1], batch_actions[:1])
 
         loss = eval_step(
             state,
             rng,
-            from_torch_to_jax(batch_depth),
-            from_torch_to_jax(batch_actions),
-            from_torch_to_jax(batch_labels),
+            prime,
+            batch_depth,
+            batch_actions,
+            batch_labels,
+            batch_mask,
             model,
         )
 
@@ -194,7 +311,7 @@ def validate(
     return jnp.mean(jnp.array(losses))
 
 
-@partial(jax.jit, static_argnums=6)
+@partial(jax.jit, static_argnums=7)
 def train_step(
     state: PyTree,
     drop_rng: PRNGKey,
@@ -202,9 +319,20 @@ def train_step(
     batch_depth: jnp.ndarray,
     batch_actions: jnp.ndarray,
     batch_depth_labels: jnp.ndarray,
+    batch_mask: jnp.ndarray,
     model: callable,
 ) -> Tuple[PyTree, float, float, float]:
 
+    # Stochastic depth draws one rng for the whole batch, see SequenceBlock
+    drop_rng, drop_path_rng = jax.random.split(drop_rng)
+    rngs = {"dropout": drop_rng, "drop_path": drop_path_rng}
+
+    # Optionally only a random subset of the timesteps is decoded for the recon loss
+    recon_idx = None
+    if model.recon_timesteps is not None:
+        sample_rng, recon_rng = jax.random.split(sample_rng)
+        recon_idx = model.sample_recon_timesteps(recon_rng, batch_mask)
+
     def loss_fn(params):
         out, updates = None, None
 
@@ -214,7 +342,8 @@ def train_step(
                 depth_imgs=batch_depth,
                 actions=batch_actions,
                 rng_seed=sample_rng,
-                rngs={"dropout": drop_rng},
+                recon_idx=recon_idx,
+                rngs=rngs,
                 mutable=["batch_stats"],
             )
         else:
@@ -223,7 +352,8 @@ def train_step(
                 depth_imgs=batch_depth,
                 actions=batch_actions,
                 rng_seed=sample_rng,
-                rngs={"dropout": drop_rng},
+                recon_idx=recon_idx,
+                rngs=rngs,
             )
 
         loss, (recon_loss, kl_loss) = model.compute_loss(
@@ -231,45 +361,70 @@ def train_step(
             img_posterior=batch_depth_labels,
             z_posterior_dist=out["z_post"]["dist"][:, 1:],
             z_prior_dist=out["z_prior"]["dist"],
+            mask=batch_mask,
+            recon_idx=recon_idx,
         )
 
-        return jnp.mean(loss), (
+        loss = jnp.mean(loss)
+        scaled_loss = (
+            loss if state.loss_scale is None else loss * state.loss_scale.scale
+        )
+
+        return scaled_loss, (
+            loss,
             jnp.mean(recon_loss),
             jnp.mean(kl_loss),
             updates,
         )
 
-    grad_fn = jax.value_and_grad(loss_fn, has_aux=True)
-    (loss, (recon_loss, kl_loss, updates)), grads = grad_fn(state.params)
-    state = state.apply_gradients(grads=grads)
-    if updates is not None:
-        state = state.replace(batch_stats=updates["batch_stats"])
+    grad_fn = jax.grad(loss_fn, has_aux=True)
+    grads, (loss, recon_loss, kl_loss, updates) = grad_fn(state.params)
+
+    if state.loss_scale is None:
+        state = state.apply_gradients(grads=grads)
+        if updates is not None:
+            state = state.replace(batch_stats=updates["batch_stats"])
+    else:
+        # Skip the update when the scaled gradients overflowed
+        grads = state.loss_scale.unscale(grads)
+        grads_finite = all_finite(grads)
+        loss_scale = state.loss_scale.adjust(grads_finite)
+
+        new_state = state.apply_gradients(grads=grads)
+        if updates is not None:
+            new_state = new_state.replace(batch_stats=updates["batch_stats"])
+        state = jax.tree_util.tree_map(
+            lambda new, old: jnp.where(grads_finite, new, old), new_state, state
+        )
+        state = state.replace(loss_scale=loss_scale)
 
     return state, loss, recon_loss, kl_loss
 
 
-@partial(jax.jit, static_argnums=5)
+@partial(jax.jit, static_argnums=7)
 def eval_step(
     state: PyTree,
     rng: PRNGKey,
+    prime: PyTree,
     batch_depth: jnp.ndarray,
     batch_actions: jnp.ndarray,
     batch_depth_labels: jnp.ndarray,
+    batch_mask: jnp.ndarray,
     model: callable,
 ) -> float:
 
     if state.batch_stats is not None:
         out = model.apply(
-            {"params": state.params, "batch_stats": state.batch_stats},
+            {"params": state.params, "batch_stats": state.batch_stats, "prime": prime},
             depth_imgs=batch_depth,
-            depth_actions=batch_actions,
+            actions=batch_actions,
             rng_seed=rng,
         )
     else:
         out = model.apply(
-            {"params": state.params},
+            {"params": state.params, "prime": prime},
             depth_imgs=batch_depth,
-            depth_actions=batch_actions,
+            actions=batch_actions,
             rng_seed=rng,
         )
 
@@ -278,6 +433,7 @@ def eval_step(
         img_posterior=batch_depth_labels,
         z_posterior_dist=out["z_post"]["dist"][:, 1:],
         z_prior_dist=out["z_prior"]["dist"],
+        mask=batch_mask,
     )
 
     loss = jnp.mean(loss)
@@ -305,15 +461,35 @@ def train(
     )
 
     # Get model class and arguments
-    layer_cls = S4Layer
+    layer_cls = SSM_LAYERS[model.layer.get("layer_type", "s4")]
     lr_layer = getattr(layer_cls, "lr", None)
 
     print(
         f"[*] Starting S4 World Model Training On Dataset: {dataset} =>> Initializing..."
     )
 
+    # Sequences of any length up to the largest bucket are padded to a bucket, see pad_to_bucket
+    length_buckets = train.get("length_buckets", None)
+    if length_buckets:
+        assert (
+            max(length_buckets) <= model.layer.l_max
+        ), "The S4 kernels must cover the largest length bucket"
+
     model_cls = partial(S4WM, S4_config=model, **wm)
 
+    # float16 gradients underflow without loss scaling, bfloat16 and float32 do not need it
+    loss_scale = train.get("loss_scale", "auto")
+    if loss_scale == "auto":
+        precision = wm.get("precision", None) or {}
+        float16 = any(
+            jnp.dtype(dtype) == jnp.float16
+            for dtypes in precision.values()
+            for dtype in dtypes.values()
+        )
+        loss_scale = 2.0**15 if float16 else None
+
+    kernel_cache = KernelCache(model_cls(training=False))
+
     state = create_train_state(
         rng,
         model_cls,
@@ -323,6 +499,7 @@ def train(
         lr_schedule=train.lr_schedule,
         weight_decay=train.weight_decay,
         total_steps=len(trainloader) * train.epochs,
+        loss_scale=loss_scale,
     )
 
     # Loop over epochs
@@ -330,11 +507,13 @@ def train(
     for epoch in range(train.epochs):
         print(f"[*] Starting Training Epoch {epoch + 1}...")
 
-        state, train_loss = train_epoch(state, train_rng, model_cls, trainloader)
+        state, train_loss = train_epoch(
+            state, train_rng, model_cls, trainloader, length_buckets
+        )
 
         print(f"[*] Running Epoch {epoch + 1} Validation...")
 
-        val_loss = validate(state, val_rng, model_cls, testloader)
+        val_loss = validate(state, val_rng, kernel_cache, testloader, length_buckets)
 
         print(f"\n=>> Epoch {epoch + 1} Metrics ===")
         print(f"\tTrain Loss: {train_loss:.5f} -- Train Loss:")
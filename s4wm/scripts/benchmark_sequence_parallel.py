@@ -0,0 +1,97 @@
+import os
+
+# Without accelerators the sequence is sharded over host devices, set before jax is imported
+os.environ.setdefault("XLA_FLAGS", "--xla_force_host_platform_device_count=4")
+os.environ["XLA_PYTHON_CLIENT_PREALLOCATE"] = "false"
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from jax.sharding import Mesh
+from s4wm.nn.s4_nn import S4Blocks, sequence_parallel, SEQ_AXIS
+from s4wm.scripts.benchmark_ssm import report, report_memory
+
+
+def check_sequence_parallel(
+    batch: int, seq_len: int, d_model: int, N: int, layer_type: str = "s4"
+) -> None:
+    """Outputs and gradients of S4Blocks with the sequence sharded over all devices against
+    RNN mode on a single device, and the time and temporary memory of a training gradient
+    of the sharded stack and of a single device CNN mode stack.
+    Every chunk fits in the kernel, so l_max is the chunk length: the sharded stack runs
+    sequences of n_devices * l_max steps.
+    """
+    mesh = Mesh(np.array(jax.devices()), (SEQ_AXIS,))
+    chunk_len = seq_len // mesh.size
+    args = dict(
+        layer={"N": N, "l_max": chunk_len, "layer_type": layer_type},
+        d_model=d_model,
+        n_blocks=4,
+        dropout=0.0,
+    )
+    x = jax.random.normal(jax.random.PRNGKey(0), (batch, seq_len, d_model))
+
+    # Sequences longer than l_max are stepped in RNN mode on a single device
+    rnn = S4Blocks(**args, rnn_mode=True, training=False)
+    variables = rnn.init(jax.random.PRNGKey(1), x[:, :1])
+    _, prime = rnn.apply(variables, x[:, :1], mutable=["prime", "cache"])
+    params = {"params": variables["params"]}
+    y_ref, _ = rnn.apply(
+        {**params, "cache": variables["cache"], "prime": prime["prime"]},
+        x,
+        mutable=["cache"],
+    )
+
+    sharded = S4Blocks(**args, seq_axis_name=SEQ_AXIS, training=False)
+    y = jax.jit(sequence_parallel(sharded.apply, mesh))(params, x)
+    print(f"[*] {layer_type}: {mesh.size} chunks of {chunk_len} steps")
+    error = jnp.abs(y - y_ref).max()
+    print(f"{'max error to RNN mode':<40} {error:8.2e}")
+    # float32 round off of the two modes, a wrong chunk state is off by the output scale
+    assert (
+        error <= 1e-4 * jnp.abs(y_ref).max()
+    ), f"Sharded {layer_type} is off by {error}"
+
+    # Gradients of the same loss, the RNN mode reference discretises inside the loss
+    def rnn_apply(params, x):
+        _, prime = rnn.apply(
+            {**params, "cache": variables["cache"]},
+            x[:, :1],
+            mutable=["prime", "cache"],
+        )
+        y, _ = rnn.apply(
+            {**params, "cache": variables["cache"], "prime": prime["prime"]},
+            x,
+            mutable=["cache"],
+        )
+        return y
+
+    loss = lambda apply: lambda params, x: jnp.mean(apply(params, x) ** 2)
+    grads_ref = jax.jit(jax.grad(loss(rnn_apply)))(params, x)
+    grads = jax.jit(jax.grad(loss(sequence_parallel(sharded.apply, mesh))))(params, x)
+    errors = jax.tree_util.tree_map(
+        lambda g, g_ref: jnp.abs(g - g_ref).max() / jnp.abs(g_ref).max(),
+        grads,
+        grads_ref,
+    )
+    error = max(jax.tree_util.tree_leaves(errors))
+    print(f"{'max relative grad error to RNN mode':<40} {error:8.2e}")
+    assert error <= 1e-3, f"Sharded {layer_type} gradients are off by {error}"
+
+    # Training gradients, on a single device the kernel has to cover the whole sequence
+    single = S4Blocks(**{**args, "layer": {**args["layer"], "l_max": seq_len}})
+    sharded = S4Blocks(**args, seq_axis_name=SEQ_AXIS)
+    for name, apply in (
+        ("single device", single.apply),
+        (f"sharded over {mesh.size} devices", sequence_parallel(sharded.apply, mesh)),
+    ):
+        grad_fn = jax.jit(jax.grad(loss(apply)))
+        report(f"grad {name}", grad_fn, params, x, n_iters=5)
+        report_memory(f"grad {name}", grad_fn, params, x)
+
+
+if __name__ == "__main__":
+    print(f"[*] Devices: {jax.devices()}")
+    for layer_type in ("s4", "s4d"):
+        check_sequence_parallel(4, 512, 64, 32, layer_type)
@@ -0,0 +1,457 @@
+import os
+import time
+import tempfile
+import jax
+import jax.numpy as jnp
+
+from functools import partial
+from jax.numpy.linalg import inv, matrix_power
+from omegaconf import DictConfig
+from typing import Callable
+
+from s4wm.nn.s4_nn import S4Blocks, reset_RNN_cache
+from s4wm.nn.s4_wm import S4WM, cast_S4WM_params
+from s4wm.nn.s4_ssm import (
+    causal_convolution,
+    causal_convolution_direct,
+    scan_SSM_assoc,
+    discrete_DPLR,
+    discrete_DPLR_C,
+    kernel_DPLR,
+    make_DPLR_HiPPO,
+    cached_DPLR_HiPPO,
+)
+
+os.environ["XLA_PYTHON_CLIENT_PREALLOCATE"] = "false"
+
+
+def benchmark(fn: Callable, *args, n_iters: int = 50) -> jnp.ndarray:
+    """Mean and std of the wall clock time of a jitted fn, excluding compilation"""
+    jax.block_until_ready(fn(*args))
+
+    times = []
+    for _ in range(n_iters):
+        start = time.time()
+        jax.block_until_ready(fn(*args))
+        times.append(time.time() - start)
+    times = jnp.array(times)
+    return jnp.mean(times), jnp.std(times)
+
+
+def report(name: str, fn: Callable, *args, n_iters: int = 50) -> None:
+    mean, std = benchmark(fn, *args, n_iters=n_iters)
+    print(f"{name:<40} {1e3 * mean:8.3f} ms +- {1e3 * std:.3f}")
+
+
+def report_memory(name: str, fn: Callable, *args) -> None:
+    """Temporary buffer size of a jitted fn as reported by XLA, if the backend provides it"""
+    memory = fn.lower(*args).compile().memory_analysis()
+    if memory is not None:
+        print(f"{name:<40} {memory.temp_size_in_bytes / 2**20:8.3f} MiB temp")
+
+
+@partial(jax.jit, static_argnums=2)
+def _jitted_causal_convolution(
+    u: jnp.ndarray, K: jnp.ndarray, convolution: Callable = causal_convolution
+) -> jnp.ndarray:
+    # (batch, l, h), (l, h)
+    conv = jax.vmap(convolution, in_axes=(1, 1), out_axes=1)
+    return jax.vmap(conv, in_axes=(0, None))(u, K)
+
+
+@jax.jit
+def _jitted_assoc_scan(
+    u: jnp.ndarray, Lambda_bar: jnp.ndarray, B_bar: jnp.ndarray
+) -> jnp.ndarray:
+    # (batch, l, h), (n), (n, h)
+    x0 = jnp.zeros(Lambda_bar.shape, dtype=jnp.complex64)
+    return jax.vmap(lambda _u: scan_SSM_assoc(Lambda_bar, _u @ B_bar.T, x0))(u)
+
+
+def _dense_Cb(Ab: jnp.ndarray, C: jnp.ndarray, L: int) -> jnp.ndarray:
+    # Reference, Cbar from an N x N inverse of I - Ab^L
+    I = jnp.eye(Ab.shape[0])
+    return C.conj() @ inv(I - matrix_power(Ab, L))
+
+
+def benchmark_discretisation(seq_len: int, N: int, d_model: int) -> None:
+    Lambda, P, B, _ = make_DPLR_HiPPO(N)
+    C = jax.random.normal(jax.random.PRNGKey(0), (d_model, N)).astype(jnp.complex64)
+    step = jnp.full((d_model, 1), 0.01)
+
+    # Mapped over the channels like cloneLayer does
+    Ab = jax.vmap(lambda _C, _step: discrete_DPLR(Lambda, P, P, B, _C, _step, seq_len))(
+        C, step
+    )[0]
+    dense = jax.jit(jax.vmap(lambda _Ab, _C: _dense_Cb(_Ab, _C, seq_len)))
+    structured = jax.jit(
+        jax.vmap(lambda _C, _step: discrete_DPLR_C(Lambda, P, P, _C, _step, seq_len))
+    )
+
+    for name, fn, args in (
+        (f"Cbar dense (N={N}, h={d_model})", dense, (Ab, C)),
+        (f"Cbar DPLR (N={N}, h={d_model})", structured, (C, step)),
+    ):
+        report(name, fn, *args, n_iters=5)
+        report_memory(name, fn, *args)
+
+
+def benchmark_cauchy(seq_len: int, N: int, d_model: int) -> None:
+    """kernel_DPLR of every channel and its gradient with the dense Cauchy evaluation and
+    with cauchy_chunked at a few chunk sizes (the cauchy_chunk_size of the layer config)
+    """
+    Lambda, P, B, _ = make_DPLR_HiPPO(N)
+    C = jax.random.normal(jax.random.PRNGKey(0), (d_model, N)).astype(jnp.complex64)
+    step = jnp.full((d_model, 1), 0.01)
+
+    for chunk_size in (None, 16, 32, 64):
+        # Mapped over the channels like cloneLayer does
+        kernel = jax.vmap(
+            lambda _C, _step: kernel_DPLR(
+                Lambda, P, P, B, _C, _step, seq_len, chunk_size
+            )
+        )
+        forward = jax.jit(kernel)
+        grad = jax.jit(jax.grad(lambda C, step: jnp.sum(kernel(C, step) ** 2)))
+        name = f"kernel_DPLR chunk={chunk_size} (N={N}, h={d_model})"
+        for suffix, fn in (("", forward), (" grad", grad)):
+            report(name + suffix, fn, C, step, n_iters=10)
+            report_memory(name + suffix, fn, C, step)
+
+
+def benchmark_sequence_ops(batch: int, seq_len: int, d_model: int, N: int) -> None:
+    key_u, key_K, key_B = jax.random.split(jax.random.PRNGKey(0), num=3)
+    u = jax.random.normal(key_u, (batch, seq_len, d_model))
+    K = jax.random.normal(key_K, (seq_len, d_model))
+    Lambda_bar = jnp.full((N // 2,), 0.9 + 0.1j, dtype=jnp.complex64)
+    B_bar = jax.random.normal(key_B, (N // 2, d_model)).astype(jnp.complex64)
+
+    report("causal_convolution (per feature)", _jitted_causal_convolution, u, K)
+    report("associative scan (MIMO)", _jitted_assoc_scan, u, Lambda_bar, B_bar)
+
+
+def benchmark_convolution() -> None:
+    """FFT against direct causal convolution, the source of DIRECT_CONV_MAX_LEN in s4_ssm"""
+    for batch in (1, 8):
+        for d_model in (256, 512, 1024):
+            for seq_len in (16, 32, 48, 64, 99):
+                u = jnp.ones((batch, seq_len, d_model))
+                K = jnp.ones((seq_len, d_model))
+                size = f"(b={batch}, l={seq_len}, h={d_model})"
+                report(f"fft {size}", _jitted_causal_convolution, u, K)
+                report(
+                    f"direct {size}",
+                    _jitted_causal_convolution,
+                    u,
+                    K,
+                    causal_convolution_direct,
+                )
+
+
+def benchmark_layers(batch: int, seq_len: int, d_model: int, N: int) -> None:
+    x = jax.random.normal(jax.random.PRNGKey(0), (batch, seq_len, d_model))
+
+    for layer_type in ("s4", "s4_batched", "s4d", "s5"):
+        model = S4Blocks(
+            layer={"layer_type": layer_type, "N": N, "l_max": seq_len},
+            d_model=d_model,
+            n_blocks=3,
+            training=False,
+        )
+        params = model.init(jax.random.PRNGKey(1), x)["params"]
+        forward = jax.jit(lambda params, x: model.apply({"params": params}, x))
+        report(f"S4Blocks forward ({layer_type})", forward, params, x)
+
+
+def benchmark_startup(seq_len: int, d_model: int, N: int, n_blocks: int = 4) -> None:
+    """Time of a model init split into the HiPPO decomposition and the rest, with a cold
+    cache, a warm in-process cache and a cache on disk as seen by a new process
+    """
+    x = jnp.zeros((1, seq_len, d_model))
+
+    def timed(fn: Callable) -> float:
+        start = time.time()
+        jax.block_until_ready(fn())
+        return time.time() - start
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        model = S4Blocks(
+            layer={"N": N, "l_max": seq_len, "hippo_cache_dir": cache_dir},
+            d_model=d_model,
+            n_blocks=n_blocks,
+            training=False,
+        )
+        init = lambda: model.init(jax.random.PRNGKey(0), x)
+
+        cached_DPLR_HiPPO.cache_clear()
+        hippo = timed(lambda: make_DPLR_HiPPO(N))
+        cold = timed(init)
+        warm = timed(init)
+        cached_DPLR_HiPPO.cache_clear()
+        disk = timed(init)
+
+    print(f"{f'HiPPO decomposition (N={N})':<40} {1e3 * hippo:8.3f} ms")
+    for name, t in (("cold", cold), ("in-process cache", warm), ("disk cache", disk)):
+        print(f"{f'S4Blocks init, {name}':<40} {1e3 * t:8.3f} ms")
+
+
+def benchmark_remat(batch: int, seq_len: int, d_model: int, N: int) -> None:
+    """Memory against compute of a training gradient of S4WM for every remat policy"""
+    key_img, key_act = jax.random.split(jax.random.PRNGKey(0))
+    imgs = jax.random.uniform(key_img, (batch, seq_len + 1, 135, 240, 1))
+    actions = jax.random.normal(key_act, (batch, seq_len, 4))
+    labels = imgs[:, 1:].reshape(batch, seq_len, -1)
+    config = DictConfig(
+        {"d_model": d_model, "n_blocks": 3, "layer": {"N": N, "l_max": seq_len}}
+    )
+
+    for policy in ("none", "sequence_block", "s4_block", "encoder_decoder", "matmuls"):
+        model = S4WM(S4_config=config, latent_dist_type="Gaussian", remat=policy)
+        params = model.init(
+            jax.random.PRNGKey(1), imgs, actions, jax.random.PRNGKey(2)
+        )["params"]
+
+        def loss_fn(params: dict, imgs: jnp.ndarray) -> jnp.ndarray:
+            out = model.apply(
+                {"params": params},
+                imgs,
+                actions,
+                jax.random.PRNGKey(3),
+                rngs={"dropout": jax.random.PRNGKey(4)},
+            )
+            loss, _ = model.compute_loss(
+                img_prior_dist=out["depth"]["recon"],
+                img_posterior=labels,
+                z_posterior_dist=out["z_post"]["dist"][:, 1:],
+                z_prior_dist=out["z_prior"]["dist"],
+            )
+            return jnp.mean(loss)
+
+        grad_fn = jax.jit(jax.grad(loss_fn))
+        compiled = grad_fn.lower(params, imgs).compile()
+        flops = (compiled.cost_analysis() or [{}])[0].get("flops", float("nan"))
+        print(f"{f'remat={policy}':<40} {flops / 1e9:8.3f} GFLOP")
+        report_memory(f"remat={policy}", grad_fn, params, imgs)
+        report(f"remat={policy}", grad_fn, params, imgs, n_iters=5)
+
+
+def benchmark_precision(batch: int, d_model: int, N: int, n_blocks: int = 4) -> None:
+    """Weight and memory traffic of an RNN mode step of S4WM, as in S4WMTorchWrapper, with
+    float32 and bfloat16 parameters and computations outside of the SSMs
+    """
+    imgs = jnp.zeros((batch, 1, 135, 240, 1))
+    actions = jnp.zeros((batch, 1, 4))
+    latent = jnp.zeros((batch, 1, 64))  # Gaussian sample of the default latent_dim
+    config = DictConfig(
+        {"d_model": d_model, "n_blocks": n_blocks, "layer": {"N": N, "l_max": 99}}
+    )
+    params = S4WM(S4_config=config, latent_dist_type="Gaussian").init(
+        jax.random.PRNGKey(0), imgs, actions, jax.random.PRNGKey(1)
+    )["params"]
+
+    for dtype in ("float32", "bfloat16"):
+        precision = DictConfig({"default": {"param_dtype": dtype, "dtype": dtype}})
+        model = S4WM(
+            S4_config=config,
+            latent_dist_type="Gaussian",
+            training=False,
+            rnn_mode=True,
+            sample_mean=True,
+            precision=precision,
+        )
+        cast = cast_S4WM_params(params, precision)
+        cache, prime = model.init_RNN_mode(cast, imgs, actions)
+
+        step = jax.jit(
+            lambda params, cache, imgs: model.apply(
+                {"params": params, "cache": cache, "prime": prime},
+                imgs,
+                actions,
+                latent,
+                jax.random.PRNGKey(2),
+                mutable=["cache"],
+                method="encode_and_step",
+            )
+        )
+        compiled = step.lower(cast, cache, imgs).compile()
+        accessed = (compiled.cost_analysis() or [{}])[0].get(
+            "bytes accessed", float("nan")
+        )
+        weights = sum(x.nbytes for x in jax.tree_util.tree_leaves(cast))
+        print(f"{f'RNN step {dtype}, weights':<40} {weights / 2**20:8.3f} MiB")
+        print(f"{f'RNN step {dtype}, bytes accessed':<40} {accessed / 2**20:8.3f} MiB")
+        report(f"RNN step {dtype}", step, cast, cache, imgs)
+
+
+def benchmark_pooling(batch: int, seq_len: int, d_model: int, N: int) -> None:
+    """FLOPs and time of a CNN mode pass and RNN mode steps of four S4Blocks, with and
+    without running the last two blocks on the sequence down pooled by four
+    """
+    x = jax.random.normal(jax.random.PRNGKey(0), (batch, seq_len, d_model))
+
+    for pooled_blocks, pool_factor in ((0, 1), (2, 4)):
+        name = f"pooled_blocks={pooled_blocks} k={pool_factor}"
+        args = dict(
+            layer={"N": N, "l_max": seq_len},
+            d_model=d_model,
+            n_blocks=4,
+            pooled_blocks=pooled_blocks,
+            pool_factor=pool_factor,
+            training=False,
+        )
+        model = S4Blocks(**args)
+        params = model.init(jax.random.PRNGKey(1), x)["params"]
+        forward = jax.jit(lambda params, x: model.apply({"params": params}, x))
+        compiled = forward.lower(params, x).compile()
+        flops = (compiled.cost_analysis() or [{}])[0].get("flops", float("nan"))
+        print(f"{f'CNN {name}':<40} {flops / 1e9:8.3f} GFLOP")
+        report(f"CNN {name}", forward, params, x, n_iters=10)
+
+        rnn = S4Blocks(**args, rnn_mode=True)
+        variables = rnn.init(jax.random.PRNGKey(1), x[:, :1])
+        _, prime = rnn.apply(
+            {**variables, "params": params}, x[:, :1], mutable=["prime", "cache"]
+        )
+        step = jax.jit(
+            lambda params, cache, x_k: rnn.apply(
+                {"params": params, "cache": cache, "prime": prime["prime"]},
+                x_k,
+                mutable=["cache"],
+            )
+        )
+        cache = variables["cache"]
+        report(f"RNN step {name}", step, params, cache, x[:, :1])
+        if pooled_blocks > 0:
+            # A whole group of steps, on one of which the coarse blocks are stepped as well
+            @jax.jit
+            def group(params, cache, x):
+                for k in range(pool_factor):
+                    _, variables = step(params, cache, x[:, k : k + 1])
+                    cache = variables["cache"]
+                return cache
+
+            # Sequences reset at different steps keep the phase of the batch, and a cache
+            # with per sequence phases is stepped on the phase of the batch as well
+            _, stepped = step(params, cache, x[:, :1])
+            reset = reset_RNN_cache(stepped["cache"], jnp.arange(batch // 2))
+            desync = {
+                **cache,
+                "pooled": {
+                    **cache["pooled"],
+                    "phase": jnp.arange(batch, dtype=jnp.int32) % pool_factor,
+                },
+            }
+            for case, group_cache in (
+                ("", cache),
+                (", half reset", reset),
+                (", desynchronized", desync),
+            ):
+                report(f"RNN group {name}{case}", group, params, group_cache, x)
+
+
+def benchmark_drop_path(batch: int, seq_len: int, d_model: int, N: int) -> None:
+    """Time of a training gradient of eight S4Blocks with stochastic depth, averaged over
+    drop_path rngs since every rng drops a different set of layers
+    """
+    x = jax.random.normal(jax.random.PRNGKey(0), (batch, seq_len, d_model))
+    keys = jax.random.split(jax.random.PRNGKey(2), 20)
+
+    for drop_path in (0.0, 0.2, 0.5):
+        model = S4Blocks(
+            layer={"N": N, "l_max": seq_len},
+            d_model=d_model,
+            n_blocks=8,
+            dropout=0.0,
+            drop_path=drop_path,
+        )
+        params = model.init(jax.random.PRNGKey(1), x)["params"]
+
+        def loss_fn(params: dict, key: jnp.ndarray) -> jnp.ndarray:
+            y = model.apply({"params": params}, x, rngs={"drop_path": key})
+            return jnp.mean(y**2)
+
+        grad_fn = jax.jit(jax.grad(loss_fn))
+        jax.block_until_ready(grad_fn(params, keys[0]))
+        start = time.time()
+        for key in keys:
+            jax.block_until_ready(grad_fn(params, key))
+        mean = (time.time() - start) / len(keys)
+        print(f"{f'drop_path={drop_path}':<40} {1e3 * mean:8.3f} ms")
+
+
+def benchmark_open_loop(
+    batch: int, d_model: int, N: int, n_steps: int = 20, n_blocks: int = 4
+) -> None:
+    """Open loop steps of S4WM in RNN mode with and without decoding, and decoding the
+    states of a whole latent only rollout in one call
+    """
+    imgs = jnp.zeros((batch, 1, 135, 240, 1))
+    actions = jnp.zeros((batch, 1, 4))
+    latent = jnp.zeros((batch, 1, 64))  # Gaussian sample of the default latent_dim
+    config = DictConfig(
+        {"d_model": d_model, "n_blocks": n_blocks, "layer": {"N": N, "l_max": 99}}
+    )
+    model = S4WM(
+        S4_config=config,
+        latent_dist_type="Gaussian",
+        training=False,
+        rnn_mode=True,
+        sample_mean=True,
+    )
+    params = model.init(jax.random.PRNGKey(0), imgs, actions, jax.random.PRNGKey(1))[
+        "params"
+    ]
+    cache, prime = model.init_RNN_mode(params, imgs, actions)
+
+    @partial(jax.jit, static_argnums=3)
+    def step(params, cache, latent, decode):
+        out, vars = model.apply(
+            {"params": params, "cache": cache, "prime": prime},
+            latent,
+            actions,
+            jax.random.PRNGKey(2),
+            decode,
+            mutable=["cache"],
+            method="forward_open_loop",
+        )
+        depth = out["depth_pred"].mean() if decode else None
+        return out["z_post_pred"]["sample"], out["hidden"], depth, vars["cache"]
+
+    report("open loop step, decoded", step, params, cache, latent, True)
+    report("open loop step, latent only", step, params, cache, latent, False)
+
+    decode = jax.jit(
+        lambda params, hidden, latent: model.apply(
+            {"params": params}, hidden, latent, method="reconstruct_depth"
+        ).mean()
+    )
+    latent, hidden, _, _ = step(params, cache, latent, False)
+    hidden = jnp.repeat(hidden, n_steps, axis=1)
+    latents = jnp.repeat(latent, n_steps, axis=1)
+    report(f"decode {n_steps} steps at once", decode, params, hidden, latents)
+
+
+if __name__ == "__main__":
+    BATCH_SIZE = 8
+    SEQ_LENGTH = 99
+    D_MODEL = 512
+    SSM_DIM = 128
+
+    print(f"[*] Devices: {jax.devices()}")
+    print(f"[*] batch={BATCH_SIZE} l={SEQ_LENGTH} d_model={D_MODEL} N={SSM_DIM}")
+
+    benchmark_sequence_ops(BATCH_SIZE, SEQ_LENGTH, D_MODEL, SSM_DIM)
+    benchmark_convolution()
+    benchmark_cauchy(SEQ_LENGTH, SSM_DIM, D_MODEL)
+    benchmark_layers(BATCH_SIZE, SEQ_LENGTH, D_MODEL, SSM_DIM)
+
+    for N in (64, 128, 256):
+        for d_model in (256, 1024):
+            benchmark_discretisation(SEQ_LENGTH, N, d_model)
+
+    benchmark_startup(SEQ_LENGTH, D_MODEL, SSM_DIM)
+    benchmark_remat(BATCH_SIZE, SEQ_LENGTH, D_MODEL, SSM_DIM)
+    benchmark_precision(BATCH_SIZE, D_MODEL, SSM_DIM)
+    benchmark_pooling(BATCH_SIZE, 4 * SEQ_LENGTH, D_MODEL, SSM_DIM)
+    benchmark_drop_path(BATCH_SIZE, SEQ_LENGTH, D_MODEL, SSM_DIM)
+    benchmark_open_loop(BATCH_SIZE, D_MODEL, SSM_DIM)
@@ -20,7 +20,7 @@ def main(cfg: DictConfig) -> None:
     VIZ_BATCH = 3
     C_MAP = "magma"
 
-    model = S4WM(S4_config=cfg.model, training=False, **cfg.wm)
+    model = S4WM(S4_config=cfg.model, training=False, **{**cfg.wm, "rnn_mode": False})
     torch.manual_seed(0)  # Dataloader order
 
     _, val_loader = create_depth_dataset(file_path=cfg.train.dataset_path, batch_size=4)
@@ -33,12 +33,10 @@ def main(cfg: DictConfig) -> None:
         "/home/mathias/dev/rl_checkpoints/gaussian_128"
     )
     params = state["params"]
-    model.init(
-        jax.random.PRNGKey(0), val_depth_images, val_actions, jax.random.PRNGKey(1)
-    )
+    prime = model.init_CNN_mode(params, val_depth_images[:1], val_actions[:1])
 
     out = model.apply(
-        {"params": params},
+        {"params": params, "prime": prime},
         val_depth_images,
         val_actions,
         jax.random.PRNGKey(2),
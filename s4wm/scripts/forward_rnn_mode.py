@@ -16,36 +16,24 @@ os.environ["XLA_PYTHON_CLIENT_PREALLOCATE"] = "false"
 
 
 @partial(jax.jit, static_argnums=(0))
-def _jitted_forward(
+def prefill(
     model: S4WM,
     params: PyTree,
     cache: PyTree,
-    prime: PyTree,
     imgs: jnp.ndarray,
     actions: jnp.ndarray,
     key: PRNGKey,
 ) -> jnp.ndarray:
-    out, vars = model.apply(
-        {
-            "params": params,
-            "cache": cache,
-            "prime": prime,
-        },
-        imgs,
-        actions,
-        key,
-        True,
-        mutable=["cache"],
-    )
+    out, cache = model.prefill_RNN_mode(params, cache, imgs, actions, key)
     return (
         out["depth"]["recon"].mean(),
         out["depth"]["pred"].mean(),
-        out["z_prior"]["sample"],
-        vars,
+        out["z_prior"]["sample"][:, -1:],
+        cache,
     )
 
 
-@partial(jax.jit, static_argnums=(0))
+@partial(jax.jit, static_argnums=(0, 7))
 def dream(
     model: S4WM,
     params: PyTree,
@@ -54,6 +42,7 @@ def dream(
     pred_posterior: jnp.ndarray,
     action: jnp.ndarray,
     key: PRNGKey,
+    decode: bool = True,
 ) -> jnp.ndarray:
     out, vars = model.apply(
         {
@@ -64,16 +53,19 @@ def dream(
         pred_posterior,
         action,
         key,
+        decode,
         mutable=["cache"],
         method="forward_open_loop",
     )
-    return out["depth_pred"].mean(), out["z_post_pred"]["sample"], vars
+    depth_pred = out["depth_pred"].mean() if decode else None
+    return depth_pred, out["z_post_pred"]["sample"], vars
 
 
 @hydra.main(version_base=None, config_path=".", config_name="test_cfg")
 def main(cfg: DictConfig) -> None:
     CTX_LENGTH = 99
     DREAM_LENGTH = 20
+    DECODE_EVERY = 1  # Decode every k-th open loop step, the others only step latents
     VIZ_BATCH = 3
     BATCH_SIZE = 4
 
@@ -102,48 +94,41 @@ def main(cfg: DictConfig) -> None:
     if not os.path.exists("imgs"):
         os.makedirs("imgs")
 
-    # Build context
-    z_post = None
+    # Build context, all frames are ingested at once by the S4 layers in CNN mode
+    sample_key, key = jax.random.split(key, num=2)
+    depth_recon, depth_pred, z_post, cache = prefill(
+        model,
+        params,
+        cache,
+        val_depth_imgs[:, : CTX_LENGTH + 1],
+        val_actions[:, :CTX_LENGTH],
+        sample_key,
+    )
 
+    # The reconstruction at step i is of the posterior of frame i + 1, files are per frame
     for i in range(CTX_LENGTH):
-        sample_key, key = jax.random.split(key, num=2)
-        depth = jnp.expand_dims(val_depth_imgs[:, i], axis=1)
-        action = jnp.expand_dims(val_actions[:, i], axis=1)
-
-        depth_recon, depth_pred, z_post, variables = _jitted_forward(
-            model,
-            params,
-            cache,
-            prime,
-            depth,
-            action,
-            sample_key,
-        )
-        cache = variables["cache"]
-
         plt.imsave(
-            f"imgs/recon_rnn_{i}.png",
-            depth_recon[VIZ_BATCH].reshape(135, 240),
+            f"imgs/recon_rnn_{i + 1}.png",
+            depth_recon[VIZ_BATCH, i].reshape(135, 240),
             cmap="magma",
             vmin=0,
             vmax=1,
         )
 
-        if i == CTX_LENGTH - 1:
-            plt.imsave(
-                f"imgs/dream_rnn_0.png",
-                depth_pred[VIZ_BATCH].reshape(135, 240),
-                cmap="magma",
-                vmin=0,
-                vmax=1,
-            )
-            plt.imsave(
-                f"imgs/dream_label_0.png",
-                val_depth_imgs[VIZ_BATCH, i + 1].reshape(135, 240),
-                cmap="magma",
-                vmin=0,
-                vmax=1,
-            )
+    plt.imsave(
+        f"imgs/dream_rnn_0.png",
+        depth_pred[VIZ_BATCH, -1].reshape(135, 240),
+        cmap="magma",
+        vmin=0,
+        vmax=1,
+    )
+    plt.imsave(
+        f"imgs/dream_label_0.png",
+        val_depth_imgs[VIZ_BATCH, CTX_LENGTH].reshape(135, 240),
+        cmap="magma",
+        vmin=0,
+        vmax=1,
+    )
 
     # Open loop predictions
 
@@ -158,10 +143,14 @@ def main(cfg: DictConfig) -> None:
         action = action.at[:, :, 1].set(0)
         action = action.at[:, :, 2].set(0)
 
+        decode = (i + 1) % DECODE_EVERY == 0
         depth_recon, z_post, variables = dream(
-            model, params, cache, prime, z_post, action, key
+            model, params, cache, prime, z_post, action, key, decode
         )
         cache = variables["cache"]
+        if not decode:
+            continue
+
         plt.imsave(
             f"imgs/dream_rnn_{i+1}.png",
             depth_recon[VIZ_BATCH].reshape(135, 240),
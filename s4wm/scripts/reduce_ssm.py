@@ -0,0 +1,217 @@
+import hydra
+import os
+import jax.numpy as jnp
+import torch
+import jax
+import orbax.checkpoint
+
+from omegaconf import DictConfig, OmegaConf
+from s4wm.nn.s4_wm import S4WM, PyTree, PRNGKey
+from s4wm.nn.s4_nn import (
+    truncate_S4_params,
+    S4_params_to_batched,
+    S4_params_to_cloned,
+    S4Blocks_to_scanned,
+    S4Blocks_to_unrolled,
+)
+from s4wm.data.dataloaders import create_depth_dataset
+from s4wm.utils.dlpack import from_torch_to_jax
+from functools import partial
+from typing import Dict, Tuple
+
+os.environ["XLA_PYTHON_CLIENT_PREALLOCATE"] = "false"
+
+
+# Layers with a modal truncation in truncate_S4_params
+REDUCIBLE_LAYERS = ("s4", "s4d", "s4_batched")
+
+
+def reducible_layer_type(model_cfg: DictConfig) -> str:
+    """Layer type of the model, raises for layers without a modal truncation"""
+    layer_type = model_cfg.layer.get("layer_type", "s4")
+    if layer_type not in REDUCIBLE_LAYERS:
+        raise NotImplementedError(
+            f"Modal truncation is not supported for {layer_type} layers, "
+            f"only for {', '.join(REDUCIBLE_LAYERS)}"
+        )
+    return layer_type
+
+
+def reduce_params(params: PyTree, model_cfg: DictConfig, N: int) -> PyTree:
+    """Modal truncation of the S4 layers of a checkpoint to state size N"""
+    layer_type = reducible_layer_type(model_cfg)
+
+    # One state of every conjugate pair is stored by S4D and by S4 with conj_sym
+    conj_sym = model_cfg.layer.get("conj_sym", False)
+    n_states = N // 2 if conj_sym or layer_type == "s4d" else N
+
+    if model_cfg.get("scan_blocks", False):
+        params = S4Blocks_to_unrolled(params)
+    if layer_type == "s4_batched":
+        params = S4_params_to_cloned(params)
+
+    params = truncate_S4_params(params, n_states, model_cfg.layer.l_max, conj_sym)
+
+    if layer_type == "s4_batched":
+        params = S4_params_to_batched(params)
+    if model_cfg.get("scan_blocks", False):
+        params = S4Blocks_to_scanned(params)
+    return params
+
+
+def kernel_errors(
+    model: S4WM,
+    params: PyTree,
+    reduced_model: S4WM,
+    reduced_params: PyTree,
+    imgs: jnp.ndarray,
+    actions: jnp.ndarray,
+) -> Dict[str, float]:
+    """Relative error of the convolution kernel of every S4 layer of the reduced model,
+    empty for a model without convolution kernels
+    """
+    kernels = model.init_CNN_mode(params, imgs, actions)
+    reduced_kernels = reduced_model.init_CNN_mode(reduced_params, imgs, actions)
+
+    errors = jax.tree_util.tree_map(
+        lambda K, K_r: jnp.linalg.norm(K - K_r) / jnp.linalg.norm(K),
+        kernels,
+        reduced_kernels,
+    )
+    return {
+        jax.tree_util.keystr(path): float(error)
+        for path, error in jax.tree_util.tree_flatten_with_path(errors)[0]
+    }
+
+
+@partial(jax.jit, static_argnums=(0))
+def prefill(
+    model: S4WM,
+    params: PyTree,
+    cache: PyTree,
+    imgs: jnp.ndarray,
+    actions: jnp.ndarray,
+    key: PRNGKey,
+) -> Tuple[jnp.ndarray, PyTree]:
+    out, cache = model.prefill_RNN_mode(params, cache, imgs, actions, key)
+    return out["z_prior"]["sample"][:, -1:], cache
+
+
+@partial(jax.jit, static_argnums=(0))
+def dream(
+    model: S4WM,
+    params: PyTree,
+    cache: PyTree,
+    prime: PyTree,
+    pred_posterior: jnp.ndarray,
+    action: jnp.ndarray,
+    key: PRNGKey,
+) -> Tuple[jnp.ndarray, ...]:  # 3 tuple
+    out, vars = model.apply(
+        {"params": params, "cache": cache, "prime": prime},
+        pred_posterior,
+        action,
+        key,
+        mutable=["cache"],
+        method="forward_open_loop",
+    )
+    return out["depth_pred"].mean(), out["z_post_pred"]["sample"], vars["cache"]
+
+
+def open_loop_predictions(
+    model: S4WM,
+    params: PyTree,
+    imgs: jnp.ndarray,
+    actions: jnp.ndarray,
+    ctx_length: int,
+    dream_length: int,
+) -> Tuple[jnp.ndarray, PyTree]:
+    """Depth predictions of dream_length open loop steps after a context of ctx_length
+    frames, and the RNN mode cache
+    """
+    key = jax.random.PRNGKey(0)
+    cache, prime = model.init_RNN_mode(params, imgs[:, :1], actions[:, :1])
+
+    sample_key, key = jax.random.split(key)
+    z, cache = prefill(
+        model,
+        params,
+        cache,
+        imgs[:, : ctx_length + 1],
+        actions[:, :ctx_length],
+        sample_key,
+    )
+
+    preds = []
+    for i in range(dream_length):
+        sample_key, key = jax.random.split(key)
+        action = actions[:, ctx_length + i][:, jnp.newaxis]
+        pred, z, cache = dream(model, params, cache, prime, z, action, sample_key)
+        preds.append(pred)
+
+    return jnp.concatenate(preds, axis=1), cache
+
+
+@hydra.main(version_base=None, config_path=".", config_name="test_cfg")
+def main(cfg: DictConfig) -> None:
+    reduce = cfg.reduce
+    # Fail before the checkpoint and the dataset are loaded
+    reducible_layer_type(cfg.model)
+
+    reduced_cfg = OmegaConf.merge(cfg.model, {"layer": {"N": reduce.N}})
+    model = S4WM(S4_config=cfg.model, training=False, **{**cfg.wm, "rnn_mode": True})
+    reduced_model = model.clone(S4_config=reduced_cfg)
+
+    params = model.restore_checkpoint_state(reduce.ckpt_path)["params"]
+    reduced_params = reduce_params(params, cfg.model, reduce.N)
+
+    torch.manual_seed(0)  # Dataloader order
+    _, val_loader = create_depth_dataset(
+        file_path=cfg.train.dataset_path, batch_size=reduce.batch_size
+    )
+    imgs, actions, _ = next(iter(val_loader))
+    imgs, actions = from_torch_to_jax(imgs), from_torch_to_jax(actions)
+
+    print(f"[*] Kernel errors, N={cfg.model.layer.N} -> N={reduce.N}")
+    errors = kernel_errors(
+        model.clone(rnn_mode=False),
+        params,
+        reduced_model.clone(rnn_mode=False),
+        reduced_params,
+        imgs[:1],
+        actions[:1],
+    )
+    for name, error in errors.items():
+        print(f"\t{name}: {error:.3e}")
+    if errors:
+        print(f"\tMean: {jnp.mean(jnp.array(list(errors.values()))):.3e}")
+
+    print(f"[*] Open loop prediction errors over {reduce.dream_length} steps")
+    args = (imgs, actions, reduce.ctx_length, reduce.dream_length)
+    preds, cache = open_loop_predictions(model, params, *args)
+    reduced_preds, reduced_cache = open_loop_predictions(
+        reduced_model, reduced_params, *args
+    )
+
+    labels = imgs[
+        :, reduce.ctx_length + 1 : reduce.ctx_length + 1 + reduce.dream_length
+    ].reshape(preds.shape)
+    mse = lambda x, y: jnp.mean((x - y) ** 2, axis=(0, 2))
+
+    print(f"\tMSE to labels, N={cfg.model.layer.N}: {mse(preds, labels)}")
+    print(f"\tMSE to labels, N={reduce.N}: {mse(reduced_preds, labels)}")
+    print(f"\tMSE between the models: {mse(preds, reduced_preds)}")
+
+    cache_bytes = lambda c: sum(x.nbytes for x in jax.tree_util.tree_leaves(c))
+    print(
+        f"[*] RNN state per environment: {cache_bytes(cache) / reduce.batch_size:.0f} "
+        f"-> {cache_bytes(reduced_cache) / reduce.batch_size:.0f} bytes"
+    )
+
+    ckptr = orbax.checkpoint.Checkpointer(orbax.checkpoint.PyTreeCheckpointHandler())
+    ckptr.save(reduce.out_path, {"params": reduced_params})
+    print(f"[*] Reduced checkpoint written to {reduce.out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Numerics of the native distributions of s4wm.nn.dists against the TFP distributions they
+replace. TFP is an optional dev dependency (requirements-dev.txt), the tests skip without it.
+"""
+
+import jax
+import jax.numpy as jnp
+import pytest
+
+from s4wm.nn.dists import DiagGaussianDist, OneHotDist, log_cosh
+
+tfp = pytest.importorskip("tensorflow_probability.substrates.jax")
+tfd = tfp.distributions
+
+keys = jax.random.split(jax.random.PRNGKey(0), 5)
+
+
+def assert_close(native: jnp.ndarray, reference: jnp.ndarray, tol: float) -> None:
+    """Max error relative to the largest reference value"""
+    error = jnp.abs(native - reference).max() / jnp.abs(reference).max()
+    assert error < tol, f"relative error {error:.2e}"
+
+
+@pytest.fixture(scope="module")
+def categorical():
+    p = jax.random.normal(keys[0], (4, 16, 32, 32))
+    q = jax.random.normal(keys[1], (4, 16, 32, 32))
+    native = OneHotDist(p), OneHotDist(q)
+    reference = (
+        tfd.Independent(tfd.OneHotCategorical(logits=p), 1),
+        tfd.Independent(tfd.OneHotCategorical(logits=q), 1),
+    )
+    return native, reference
+
+
+@pytest.fixture(scope="module")
+def gaussian():
+    mean_p, mean_q = jax.random.normal(keys[3], (2, 4, 16, 512))
+    std_p, std_q = jax.nn.softplus(jax.random.normal(keys[4], (2, 4, 16, 512))) + 0.1
+    native = DiagGaussianDist(mean_p, std_p), DiagGaussianDist(mean_q, std_q)
+    reference = (
+        tfd.Independent(tfd.Normal(mean_p, std_p), 1),
+        tfd.Independent(tfd.Normal(mean_q, std_q), 1),
+    )
+    return native, reference
+
+
+def test_categorical_kl(categorical):
+    (p, q), (tfp_p, tfp_q) = categorical
+    assert_close(p.kl_divergence(q), tfp_p.kl_divergence(tfp_q), 1e-5)
+
+
+def test_categorical_slice(categorical):
+    (p, q), (tfp_p, tfp_q) = categorical
+    assert_close(
+        p[:, 1:].kl_divergence(q[:, 1:]), tfp_p[:, 1:].kl_divergence(tfp_q[:, 1:]), 1e-5
+    )
+
+
+def test_categorical_entropy(categorical):
+    (p, _), (tfp_p, _) = categorical
+    assert_close(p.entropy(), tfp_p.entropy(), 1e-5)
+
+
+def test_categorical_log_prob(categorical):
+    (p, _), (tfp_p, _) = categorical
+    sample = p.sample(seed=keys[2])
+    assert_close(p.log_prob(sample), tfp_p.log_prob(sample), 1e-5)
+
+
+def test_categorical_sample_and_mode(categorical):
+    (p, _), (tfp_p, _) = categorical
+    sample = p.sample(seed=keys[2])
+    assert jnp.all(sample.sum(-1) == 1.0)
+    assert jnp.array_equal(p.mode(), tfp_p.mode())
+
+
+def test_gaussian_kl(gaussian):
+    (p, q), (tfp_p, tfp_q) = gaussian
+    assert_close(p.kl_divergence(q), tfp_p.kl_divergence(tfp_q), 1e-5)
+
+
+def test_gaussian_entropy(gaussian):
+    (p, _), (tfp_p, _) = gaussian
+    assert_close(p.entropy(), tfp_p.entropy(), 1e-5)
+
+
+def test_gaussian_log_prob(gaussian):
+    (p, _), (tfp_p, _) = gaussian
+    sample = p.sample(seed=keys[2])
+    assert_close(p.log_prob(sample), tfp_p.log_prob(sample), 1e-5)
+
+
+def test_log_cosh():
+    x = jnp.linspace(-100, 100, 1001)
+    assert_close(log_cosh(x), tfp.math.log_cosh(x), 1e-6)
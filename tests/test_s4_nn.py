@@ -0,0 +1,179 @@
+"""Conversions of S4Blocks checkpoints between layouts of s4wm.nn.s4_nn: the converted
+parameters have to reproduce the outputs of the original layout and convert back exactly.
+"""
+
+import jax
+import jax.numpy as jnp
+import pytest
+
+from functools import partial
+
+from s4wm.nn.s4_nn import (
+    S4_params_to_batched,
+    S4_params_to_cloned,
+    S4Blocks,
+    S4Blocks_to_scanned,
+    S4Blocks_to_unrolled,
+    reset_RNN_cache,
+)
+
+B, L, H = 2, 12, 8
+keys = jax.random.split(jax.random.PRNGKey(0), 3)
+u = jax.random.normal(keys[0], (B, L, H))
+
+
+def make_blocks(
+    layer_type: str, rnn_mode: bool = False, n_blocks: int = 2, **kwargs
+) -> S4Blocks:
+    return S4Blocks(
+        layer={"layer_type": layer_type, "N": 8, "l_max": 16},
+        d_model=H,
+        n_layers=2,
+        n_blocks=n_blocks,
+        dropout=0.0,
+        training=False,
+        rnn_mode=rnn_mode,
+        **kwargs,
+    )
+
+
+def apply_RNN_mode(
+    model: S4Blocks, params, u: jnp.ndarray, return_cache: bool = False
+) -> jnp.ndarray:
+    """Step model through u one step at a time from a zero state, optionally also returning
+    the final cache
+    """
+    variables = model.init(keys[1], u[:, :1])
+    _, primed = model.apply(
+        {**variables, "params": params}, u[:, :1], mutable=["prime", "cache"]
+    )
+    variables = {**variables, **primed, "params": params}
+    step = jax.jit(partial(model.apply, mutable=["cache"]))
+    ys = []
+    for k in range(u.shape[1]):
+        y, cache = step(variables, u[:, k : k + 1])
+        variables = {**variables, **cache}
+        ys.append(y)
+    y = jnp.concatenate(ys, axis=1)
+    return (y, variables["cache"]) if return_cache else y
+
+
+def assert_trees_equal(a, b) -> None:
+    assert jax.tree_util.tree_structure(a) == jax.tree_util.tree_structure(b)
+    for x, y in zip(jax.tree_util.tree_leaves(a), jax.tree_util.tree_leaves(b)):
+        assert x.shape == y.shape and jnp.array_equal(x, y)
+
+
+def assert_close(native: jnp.ndarray, reference: jnp.ndarray, tol: float) -> None:
+    """Max error relative to the largest reference value"""
+    error = jnp.abs(native - reference).max() / jnp.abs(reference).max()
+    assert error < tol, f"relative error {error:.2e}"
+
+
+@pytest.fixture(scope="module")
+def cloned():
+    return make_blocks("s4").init(keys[1], u)["params"]
+
+
+def test_S4_params_round_trip(cloned):
+    batched = S4_params_to_batched(cloned)
+    init = make_blocks("s4_batched").init(keys[1], u)["params"]
+    assert jax.tree_util.tree_map(jnp.shape, batched) == jax.tree_util.tree_map(
+        jnp.shape, init
+    )
+    assert_trees_equal(S4_params_to_cloned(batched), cloned)
+
+
+def test_S4_params_to_batched_outputs(cloned):
+    batched = S4_params_to_batched(cloned)
+    y = make_blocks("s4").apply({"params": cloned}, u)
+    assert_close(make_blocks("s4_batched").apply({"params": batched}, u), y, 1e-5)
+    assert_close(
+        apply_RNN_mode(make_blocks("s4_batched", rnn_mode=True), batched, u), y, 1e-4
+    )
+
+
+def test_S4_params_scanned_blocks():
+    scanned = make_blocks("s4", scan_blocks=True).init(keys[1], u)["params"]
+    with pytest.raises(AssertionError, match="S4Blocks_to_unrolled"):
+        S4_params_to_batched(scanned)
+
+    scanned = make_blocks("s4_batched", scan_blocks=True).init(keys[1], u)["params"]
+    with pytest.raises(AssertionError, match="S4Blocks_to_unrolled"):
+        S4_params_to_cloned(scanned)
+
+
+@pytest.mark.parametrize("pooled_blocks", [0, 2])
+def test_S4Blocks_to_scanned(pooled_blocks):
+    kwargs = dict(n_blocks=4, pooled_blocks=pooled_blocks, pool_factor=2)
+    unrolled = make_blocks("s4", **kwargs).init(keys[1], u)["params"]
+    scanned = S4Blocks_to_scanned(unrolled)
+    init = make_blocks("s4", scan_blocks=True, **kwargs).init(keys[1], u)["params"]
+    assert jax.tree_util.tree_map(jnp.shape, scanned) == jax.tree_util.tree_map(
+        jnp.shape, init
+    )
+    assert_trees_equal(S4Blocks_to_unrolled(scanned), unrolled)
+
+    y = make_blocks("s4", **kwargs).apply({"params": unrolled}, u)
+    y_scanned = make_blocks("s4", scan_blocks=True, **kwargs).apply(
+        {"params": scanned}, u
+    )
+    assert_close(y_scanned, y, 1e-5)
+
+    # The cache has the batch on axis 0 and the blocks stacked on axis 1
+    y_rnn, cache = apply_RNN_mode(
+        make_blocks("s4", rnn_mode=True, **kwargs), unrolled, u, return_cache=True
+    )
+    y_rnn_scanned, cache_scanned = apply_RNN_mode(
+        make_blocks("s4", rnn_mode=True, scan_blocks=True, **kwargs),
+        scanned,
+        u,
+        return_cache=True,
+    )
+    assert_close(y_rnn_scanned, y_rnn, 1e-5)
+    for x, y in zip(
+        jax.tree_util.tree_leaves(S4Blocks_to_scanned(cache, axis=1)),
+        jax.tree_util.tree_leaves(cache_scanned),
+    ):
+        assert jnp.allclose(x, y, rtol=1e-4, atol=1e-5)
+    assert_trees_equal(
+        S4Blocks_to_unrolled(S4Blocks_to_scanned(cache, axis=1), axis=1), cache
+    )
+
+
+def test_reset_RNN_cache():
+    """Resetting a sequence of pooled S4Blocks within a group keeps the phase of the batch
+    and leaves the other sequences unchanged
+    """
+    kwargs = dict(n_blocks=3, pooled_blocks=1, pool_factor=4)
+    params = make_blocks("s4", **kwargs).init(keys[1], u)["params"]
+    model = make_blocks("s4", rnn_mode=True, **kwargs)
+    variables = model.init(keys[1], u[:, :1])
+    _, primed = model.apply(
+        {**variables, "params": params}, u[:, :1], mutable=["prime", "cache"]
+    )
+    step = jax.jit(
+        lambda cache, u_k: model.apply(
+            {"params": params, "prime": primed["prime"], "cache": cache},
+            u_k,
+            mutable=["cache"],
+        )
+    )
+
+    def run(cache, u):
+        ys = []
+        for k in range(u.shape[1]):
+            y, variables = step(cache, u[:, k : k + 1])
+            cache = variables["cache"]
+            ys.append(y)
+        return jnp.concatenate(ys, axis=1), cache
+
+    _, cache = run(variables["cache"], u[:, :2])
+    reset = reset_RNN_cache(cache, jnp.array([0]))
+    assert jnp.array_equal(reset["pooled"]["phase"], cache["pooled"]["phase"])
+    assert not jnp.any(reset["pooled"]["pool_inputs"][0])
+
+    y, cache = run(cache, u[:, 2:])
+    y_reset, reset = run(reset, u[:, 2:])
+    assert jnp.allclose(y_reset[1:], y[1:], rtol=1e-6, atol=1e-6)
+    assert jnp.array_equal(reset["pooled"]["phase"], cache["pooled"]["phase"])
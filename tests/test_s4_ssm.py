@@ -0,0 +1,71 @@
+"""Numerics of the structured DPLR discretisation of s4wm.nn.s4_ssm against the dense
+N x N computation it replaces, and of the convolutional against the recurrent view.
+"""
+
+import jax
+import jax.numpy as jnp
+import pytest
+
+from jax.numpy.linalg import inv, matrix_power
+
+from s4wm.nn.s4_ssm import (
+    cached_DPLR_HiPPO,
+    causal_convolution,
+    conj_pair,
+    discrete_DPLR,
+    discrete_DPLR_C,
+    kernel_DPLR,
+    scan_SSM,
+)
+
+N, L = 16, 32
+keys = jax.random.split(jax.random.PRNGKey(0), 3)
+
+
+def assert_close(native: jnp.ndarray, reference: jnp.ndarray, tol: float) -> None:
+    """Max error relative to the largest reference value"""
+    error = jnp.abs(native - reference).max() / jnp.abs(reference).max()
+    assert error < tol, f"relative error {error:.2e}"
+
+
+def make_ssm(conj_sym: bool):
+    """HiPPO Lambda, P and B as S4Layer initialises them, with a random C"""
+    Lambda, P, B = map(jnp.asarray, cached_DPLR_HiPPO(N)[:3])
+    if conj_sym:
+        # One eigenvalue of every conjugate pair, as in hippo_initializer
+        Lambda, P, B = Lambda[N // 2 :], P[N // 2 :], B[N // 2 :]
+    C = jax.random.normal(keys[0], (Lambda.shape[0], 2)) @ jnp.array([1.0, 1j])
+    return Lambda, P, B, C
+
+
+def dense_Cb(Lambda, P, B, C, step, conj_sym):
+    """Cbar = Ct (I - Ab^L)^-1 from the N x N matrix power and inverse"""
+    if conj_sym:
+        n = Lambda.shape[0]
+        return dense_Cb(*map(conj_pair, (Lambda, P, B, C)), step, False)[:n]
+
+    Ab, _, _ = discrete_DPLR(Lambda, P, P, B, C, step, L)
+    return C.conj() @ inv(jnp.eye(Ab.shape[0]) - matrix_power(Ab, L))
+
+
+@pytest.mark.parametrize("conj_sym", [False, True])
+@pytest.mark.parametrize("step", [0.001, 0.01, 0.1])
+def test_discrete_DPLR_C(conj_sym, step):
+    Lambda, P, B, C = make_ssm(conj_sym)
+    Cb = discrete_DPLR_C(Lambda, P, P, C, step, L, conj_sym)
+    assert_close(Cb, dense_Cb(Lambda, P, B, C, step, conj_sym), 1e-4)
+
+
+@pytest.mark.parametrize("conj_sym", [False, True])
+def test_kernel_matches_recurrence(conj_sym):
+    Lambda, P, B, C = make_ssm(conj_sym)
+    step = 0.01
+    u = jax.random.normal(keys[1], (L,))
+
+    K = kernel_DPLR(Lambda, P, P, B, C, step, L, conj_sym=conj_sym)
+    y_cnn = causal_convolution(u, K)
+
+    Ab, Bb, Cb = discrete_DPLR(Lambda, P, P, B, C, step, L, conj_sym)
+    x_0 = jnp.zeros(Lambda.shape[0], jnp.complex64)
+    _, y_rnn = scan_SSM(Ab, Bb, Cb, u[:, jnp.newaxis], x_0, conj_sym)
+    assert_close(y_cnn, y_rnn.reshape(-1).real, 1e-4)
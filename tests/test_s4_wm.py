@@ -0,0 +1,98 @@
+"""S4WM.prefill_RNN_mode: ingesting a context in one CNN mode call has to leave the same
+cache and outputs as stepping through it in RNN mode, for every SSM layer type.
+"""
+
+import jax
+import jax.numpy as jnp
+import pytest
+
+from omegaconf import DictConfig
+
+from s4wm.nn.s4_wm import S4WM
+
+T = 6
+keys = jax.random.split(jax.random.PRNGKey(0), 4)
+imgs = jax.random.uniform(keys[0], (2, T + 1, 135, 240, 1))
+actions = jax.random.normal(keys[1], (2, T, 4))
+
+LAYERS = {
+    "s4": {},
+    "s4_structured_step": {"structured_step": True},
+    "s4d": {"layer_type": "s4d"},
+    "s5": {"layer_type": "s5"},
+}
+
+
+def assert_close(native: jnp.ndarray, reference: jnp.ndarray, tol: float) -> None:
+    """Max error relative to the largest reference value"""
+    error = jnp.abs(native - reference).max() / jnp.abs(reference).max()
+    assert error < tol, f"relative error {error:.2e}"
+
+
+def assert_caches_close(native, reference, tol: float) -> None:
+    assert jax.tree_util.tree_structure(native) == jax.tree_util.tree_structure(
+        reference
+    )
+    for x, y in zip(
+        jax.tree_util.tree_leaves(native), jax.tree_util.tree_leaves(reference)
+    ):
+        assert jnp.allclose(x, y, rtol=tol, atol=tol * jnp.abs(y).max())
+
+
+@pytest.fixture(scope="module", params=list(LAYERS))
+def stepped(request):
+    """Model, parameters and the caches and outputs of stepping through the context"""
+    S4_config = DictConfig(
+        {
+            "d_model": 16,
+            "n_layers": 2,
+            "n_blocks": 2,
+            "layer": {"N": 8, "l_max": 12, **LAYERS[request.param]},
+        }
+    )
+    kwargs = dict(
+        S4_config=S4_config,
+        training=False,
+        latent_dist_type="Gaussian",
+        latent_dim=16,
+        sample_mean=True,
+    )
+    params = S4WM(**kwargs).init(keys[2], imgs, actions, keys[3])["params"]
+    model = S4WM(**kwargs, rnn_mode=True)
+    cache, prime = model.init_RNN_mode(params, imgs[:, :1], actions[:, :1])
+
+    @jax.jit
+    def step(cache, img, action):
+        out, variables = model.apply(
+            {"params": params, "cache": cache, "prime": prime},
+            img,
+            action,
+            keys[3],
+            mutable=["cache"],
+        )
+        return variables["cache"], out["hidden"]
+
+    caches, hidden = [cache], []
+    for k in range(T):
+        cache, h = step(cache, imgs[:, k : k + 1], actions[:, k : k + 1])
+        caches.append(cache)
+        hidden.append(h)
+    return model, params, caches, jnp.concatenate(hidden, axis=1)
+
+
+def test_prefill(stepped):
+    model, params, caches, hidden = stepped
+    out, cache = model.prefill_RNN_mode(params, caches[0], imgs, actions, keys[3])
+    assert_close(out["hidden"], hidden, 1e-4)
+    assert_caches_close(cache, caches[-1], 1e-4)
+
+
+def test_prefill_from_state(stepped):
+    """A prefill continuing from the cache of a partially stepped context"""
+    model, params, caches, hidden = stepped
+    k = T // 2
+    out, cache = model.prefill_RNN_mode(
+        params, caches[k], imgs[:, k:], actions[:, k:], keys[3]
+    )
+    assert_close(out["hidden"], hidden[:, k:], 1e-4)
+    assert_caches_close(cache, caches[-1], 1e-4)